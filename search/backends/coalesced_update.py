@@ -0,0 +1,68 @@
+"""
+Buffers index updates and writes them in one batch per search manager.
+
+Repeated saves of the same entity are collapsed into a single update. The
+buffer is flushed by CoalescedUpdateMiddleware at the end of each request, when
+the outermost coalesced_updates() block exits or when flush() gets called.
+Outside of requests and coalesced_updates() blocks updates get written
+immediately.
+"""
+from contextlib import contextmanager
+import threading
+
+_state = threading.local()
+
+def _get_pending():
+    if not hasattr(_state, 'pending'):
+        _state.pending = {}
+        _state.depth = 0
+        _state.in_request = False
+    return _state.pending
+
+def update_relation_index(search_manager, parent_pk, delete, instance=None):
+    pending = _get_pending()
+    if not _state.depth and not _state.in_request:
+        search_manager.update_relation_index(parent_pk, delete,
+                                             parent=instance)
+        return
+    # Only remember the pk. The parent gets re-read when flushing, so unsaved
+    # changes and rolled back saves don't get indexed.
+    pending.setdefault(search_manager, set()).add(parent_pk)
+
+def flush():
+    """Writes all index updates which were buffered by the current thread."""
+    pending = _get_pending()
+    _state.pending = {}
+    for search_manager, parent_pks in pending.items():
+        # pks whose parent doesn't exist anymore get their index removed
+        search_manager.update_relation_indexes(parent_pks)
+
+@contextmanager
+def coalesced_updates():
+    """
+    Buffers all index updates within the block and flushes them at the end of
+    the outermost block.
+    """
+    _get_pending()
+    _state.depth += 1
+    try:
+        yield
+    finally:
+        _state.depth -= 1
+        if not _state.depth:
+            flush()
+
+class CoalescedUpdateMiddleware(object):
+    def process_request(self, request):
+        _get_pending()
+        _state.depth = 0
+        _state.in_request = True
+
+    def process_response(self, request, response):
+        _state.in_request = False
+        flush()
+        return response
+
+    def process_exception(self, request, exception):
+        _state.in_request = False
+        flush()
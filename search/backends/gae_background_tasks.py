@@ -1,18 +1,100 @@
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
 from django.db import models
-from google.appengine.ext import deferred
+import threading
+
+try:
+    from google.appengine.ext.deferred import defer as gae_defer
+except ImportError:
+    gae_defer = None
 
 default_search_queue = getattr(settings, 'DEFAULT_SEARCH_QUEUE', 'default')
+# Updates get collected for up to SEARCH_TASK_WINDOW seconds (or until the
+# request ends) and are then processed by a single task
+search_task_window = getattr(settings, 'SEARCH_TASK_WINDOW', 1)
+search_task_batch_size = getattr(settings, 'SEARCH_TASK_BATCH_SIZE', 100)
+
+_state = threading.local()
+
+def get_defer():
+    # SEARCH_LOCAL_TASK_QUEUE allows for using this backend outside of App
+    # Engine (e.g., in tests), see search.backends.local_queue
+    if getattr(settings, 'SEARCH_LOCAL_TASK_QUEUE', False):
+        from search.backends.local_queue import defer
+        return defer
+    if gae_defer is None:
+        raise ImproperlyConfigured('The gae_background_tasks search backend '
+            'requires App Engine. Set SEARCH_LOCAL_TASK_QUEUE to use '
+            'search.backends.local_queue instead.')
+    return gae_defer
+
+class Batch(object):
+    """The updates collected by a thread."""
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        # Enforces the window outside of requests
+        self.timer = None
+
+def _get_batch():
+    if not hasattr(_state, 'batch'):
+        _state.batch = Batch()
+    return _state.batch
 
-def update_relation_index(search_manager, parent_pk, delete):
+def update_relation_index(search_manager, parent_pk, delete, instance=None):
     # pass only the field / model names to the background task to transfer less
-    # data
-    app_label = search_manager.model._meta.app_label
-    object_name = search_manager.model._meta.object_name
-    deferred.defer(update, app_label, object_name, search_manager.name,
-        parent_pk, delete, _queue=default_search_queue)
+    # data. The task re-reads the instance, so it always indexes the latest
+    # version
+    get_defer()
+    batch = _get_batch()
+    key = (search_manager.model._meta.app_label,
+           search_manager.model._meta.object_name, search_manager.name)
+    batch.lock.acquire()
+    try:
+        pks = batch.pending.setdefault(key, set())
+        pks.add(parent_pk)
+        full = len(pks) >= search_task_batch_size
+        if not full and batch.timer is None:
+            batch.timer = threading.Timer(search_task_window, flush_batch,
+                                          (batch,))
+            batch.timer.setDaemon(True)
+            batch.timer.start()
+    finally:
+        batch.lock.release()
+    if full:
+        flush_batch(batch)
+
+def flush_batch(batch):
+    """Enqueues one task per search manager for the batch's updates."""
+    batch.lock.acquire()
+    try:
+        pending, batch.pending = batch.pending, {}
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+    finally:
+        batch.lock.release()
+    if not pending:
+        return
+    defer = get_defer()
+    for (app_label, object_name, manager_name), pks in pending.items():
+        defer(update_batch, app_label, object_name, manager_name, list(pks),
+            _queue=default_search_queue)
+
+def flush(**kwargs):
+    """Enqueues the updates collected by the current thread."""
+    flush_batch(_get_batch())
+request_finished.connect(flush)
+
+def update_batch(app_label, object_name, manager_name, parent_pks):
+    model = models.get_model(app_label, object_name)
+    manager = getattr(model, manager_name)
+    # Deleted parents can't be fetched anymore, so their index gets removed
+    manager.update_relation_indexes(parent_pks)
 
 def update(app_label, object_name, manager_name, parent_pk, delete):
+    # Kept for tasks which were enqueued before update_batch() existed
     model = models.get_model(app_label, object_name)
     manager = getattr(model, manager_name)
-    manager.update_relation_index(parent_pk, delete)
\ No newline at end of file
+    manager.update_relation_index(parent_pk, delete)
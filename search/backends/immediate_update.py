@@ -1,2 +1,3 @@
-def update_relation_index(search_manager, parent_pk, delete):
-    search_manager.update_relation_index(parent_pk, delete)
\ No newline at end of file
+def update_relation_index(search_manager, parent_pk, delete, instance=None):
+    # we're running in the same request, so the saved instance is up to date
+    search_manager.update_relation_index(parent_pk, delete, parent=instance)
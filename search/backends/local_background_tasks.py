@@ -0,0 +1,173 @@
+"""
+Updates relation indexes in a local thread or process pool.
+
+Settings:
+SEARCH_WORKER_POOL: 'thread' (default) or 'process'
+SEARCH_WORKERS: number of workers (default: 2)
+SEARCH_QUEUE_SIZE: maximum number of pending updates (default: 1000)
+SEARCH_QUEUE_TIMEOUT: seconds to wait for a free queue slot before the update
+    gets executed on the calling thread. None (default) waits forever.
+SEARCH_SYNCHRONOUS_UPDATES: execute all updates immediately (useful for tests)
+SEARCH_TASK_TIMEOUT: seconds after which an update running in a worker process
+    is considered lost (e.g., because the process crashed) (default: 60)
+"""
+from django.conf import settings
+from django.db import models
+from Queue import Queue, Full
+import atexit
+import logging
+import threading
+import time
+
+_lock = threading.Lock()
+_queue = None
+_pool = None
+_pool_slots = None
+# Results of the process pool's updates, see _reap()
+_results = None
+_workers = []
+
+def update_relation_index(search_manager, parent_pk, delete, instance=None):
+    # like with deferred tasks only the names get passed to the workers, so
+    # the workers re-read the instance
+    args = (search_manager.model._meta.app_label,
+            search_manager.model._meta.object_name, search_manager.name,
+            parent_pk, delete)
+    if getattr(settings, 'SEARCH_SYNCHRONOUS_UPDATES', False):
+        update(*args)
+        return
+
+    _start()
+    timeout = getattr(settings, 'SEARCH_QUEUE_TIMEOUT', None)
+    if _pool is not None:
+        if timeout is None:
+            _pool_slots.acquire()
+        elif not _acquire_with_timeout(_pool_slots, timeout):
+            # Apply backpressure by doing the work ourselves
+            update(*args)
+            return
+        _results.put(_pool.apply_async(_safe_update, args))
+        return
+    try:
+        _queue.put(args, True, timeout)
+    except Full:
+        # Apply backpressure by doing the work ourselves
+        update(*args)
+
+def _acquire_with_timeout(semaphore, timeout):
+    # Semaphore.acquire() doesn't support timeouts, so we poll
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if semaphore.acquire(False):
+            return True
+        time.sleep(0.01)
+    return semaphore.acquire(False)
+
+def update(app_label, object_name, manager_name, parent_pk, delete):
+    model = models.get_model(app_label, object_name)
+    manager = getattr(model, manager_name)
+    manager.update_relation_index(parent_pk, delete)
+
+def _safe_update(*args):
+    try:
+        update(*args)
+    except:
+        logging.exception('Error while updating the search index')
+
+def _work():
+    while True:
+        args = _queue.get()
+        try:
+            if args is None:
+                return
+            _safe_update(*args)
+        finally:
+            _queue.task_done()
+
+def _reap():
+    # Frees the slots of finished updates. Failed or lost updates have to free
+    # their slot, too, so we don't rely on apply_async()'s callback.
+    timeout = getattr(settings, 'SEARCH_TASK_TIMEOUT', 60)
+    while True:
+        result = _results.get()
+        try:
+            if result is None:
+                return
+            result.wait(timeout)
+            if not result.ready():
+                logging.error('Search index update timed out, the worker '
+                              'process probably crashed')
+            elif not result.successful():
+                logging.error('Search index update failed in the worker '
+                              'process')
+            _pool_slots.release()
+        finally:
+            _results.task_done()
+
+def _close_connection():
+    # forked workers must not share the parent's database connection
+    from django.db import connection
+    connection.close()
+
+def _start():
+    global _queue, _pool, _pool_slots, _results
+    if _queue is not None or _pool is not None:
+        return
+    _lock.acquire()
+    try:
+        if _queue is not None or _pool is not None:
+            return
+        workers = getattr(settings, 'SEARCH_WORKERS', 2)
+        queue_size = getattr(settings, 'SEARCH_QUEUE_SIZE', 1000)
+        if getattr(settings, 'SEARCH_WORKER_POOL', 'thread') == 'process':
+            from multiprocessing import Pool
+            _pool_slots = threading.BoundedSemaphore(queue_size)
+            _pool = Pool(workers, initializer=_close_connection)
+            _results = Queue()
+            reaper = threading.Thread(target=_reap,
+                                      name='search-index-reaper')
+            reaper.setDaemon(True)
+            reaper.start()
+            _workers.append(reaper)
+        else:
+            _queue = Queue(queue_size)
+            for i in range(workers):
+                worker = threading.Thread(target=_work,
+                                          name='search-index-worker-%d' % i)
+                worker.setDaemon(True)
+                worker.start()
+                _workers.append(worker)
+        atexit.register(shutdown)
+    finally:
+        _lock.release()
+
+def drain():
+    """Blocks until all pending updates have been executed."""
+    if _queue is not None:
+        _queue.join()
+    elif _pool is not None:
+        _results.join()
+
+def shutdown():
+    """Executes all pending updates and stops the workers."""
+    global _queue, _pool, _pool_slots, _results
+    _lock.acquire()
+    try:
+        if _queue is not None:
+            for worker in _workers:
+                _queue.put(None)
+            for worker in _workers:
+                worker.join()
+            del _workers[:]
+            _queue = None
+        elif _pool is not None:
+            _pool.close()
+            _results.join()
+            _pool.join()
+            _results.put(None)
+            for worker in _workers:
+                worker.join()
+            del _workers[:]
+            _pool = _pool_slots = _results = None
+    finally:
+        _lock.release()
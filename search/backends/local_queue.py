@@ -0,0 +1,20 @@
+"""
+Stand-in for App Engine's deferred library, so task based backends can be used
+and tested without App Engine. Tasks are collected until run_tasks() is called.
+"""
+tasks = []
+
+def defer(func, *args, **kwargs):
+    # drop task options like _queue or _countdown
+    kwargs = dict((key, value) for key, value in kwargs.items()
+                  if not key.startswith('_'))
+    tasks.append((func, args, kwargs))
+
+def run_tasks():
+    """Executes all queued tasks (including those queued by the tasks)."""
+    count = 0
+    while tasks:
+        func, args, kwargs = tasks.pop(0)
+        func(*args, **kwargs)
+        count += 1
+    return count
@@ -0,0 +1,35 @@
+"""
+Compact probabilistic term sets. A BloomFilter never claims that an added term
+is missing, but it might claim to contain a term which was never added (with
+a probability of about "error_rate").
+"""
+from hashlib import md5
+import math
+import struct
+
+class BloomFilter(object):
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.hash_count = max(int(round(
+            float(self.size) / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, term):
+        if not isinstance(term, unicode):
+            term = unicode(term)
+        # Double hashing: derive all positions from a single digest
+        first, second = struct.unpack('<QQ', md5(term.encode('utf-8')).digest())
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, term):
+        for position in self._positions(term):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, term):
+        for position in self._positions(term):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
@@ -1,12 +1,29 @@
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.db.models import signals
 from djangotoolbox.fields import ListField
 from djangotoolbox.utils import getattr_by_path
+from search.bloom import BloomFilter
+from search.models import IndexTerm, IndexStatistics
+from search.porter_stemmers import get_stemmer
 from copy import deepcopy
+from hashlib import md5
+import base64
+import heapq
+import inspect
+import itertools
+import math
 import re
 import string
+import uuid
+
+try:
+    from djangoappengine.db.utils import get_cursor, set_cursor
+except ImportError:
+    # Other backends page via offsets
+    get_cursor = set_cursor = None
 
 _PUNCTUATION_REGEX = re.compile(
     '[' + re.escape(string.punctuation.replace('-', '').replace(
@@ -15,6 +32,31 @@ _PUNCTUATION_SEARCH_REGEX = re.compile(
     '[' + re.escape(string.punctuation.replace('_', '').replace(
         '#', '')) + ']')
 
+# Number of terms a prefix gets expanded to and the number of terms scanned
+# in order to find the most frequent ones
+PREFIX_EXPANSION_LIMIT = getattr(settings, 'SEARCH_PREFIX_EXPANSION_LIMIT', 10)
+PREFIX_SCAN_LIMIT = getattr(settings, 'SEARCH_PREFIX_SCAN_LIMIT', 100)
+# Maximum number of values per "pk__in" query
+IN_QUERY_LIMIT = getattr(settings, 'SEARCH_IN_QUERY_LIMIT', 100)
+# Number of results fetched at once while iterating over search results
+ITERATOR_BATCH_SIZE = getattr(settings, 'SEARCH_ITERATOR_BATCH_SIZE', 100)
+# Query planning for search managers with a term dictionary: terms occurring
+# in more than COMMON_TERM_RATIO of all entities get dropped (None disables
+# this) and at most MAX_TERM_FILTERS terms get combined in a single query.
+# The remaining terms get merged in the application.
+COMMON_TERM_RATIO = getattr(settings, 'SEARCH_COMMON_TERM_RATIO', None)
+MAX_TERM_FILTERS = getattr(settings, 'SEARCH_MAX_TERM_FILTERS', None)
+# False positive rate and cache lifetime of term filters
+TERM_FILTER_ERROR_RATE = getattr(settings, 'SEARCH_TERM_FILTER_ERROR_RATE',
+                                 0.01)
+TERM_FILTER_TIMEOUT = getattr(settings, 'SEARCH_TERM_FILTER_TIMEOUT',
+                              7 * 24 * 3600)
+# BM25 parameters and the number of matches ranked by ranked searches
+BM25_K1 = getattr(settings, 'SEARCH_BM25_K1', 1.2)
+BM25_B = getattr(settings, 'SEARCH_BM25_B', 0.75)
+SCORING_CANDIDATE_LIMIT = getattr(settings, 'SEARCH_SCORING_CANDIDATE_LIMIT',
+                                  1000)
+
 # Various base indexers
 def startswith(words, indexing, **kwargs):
     """Allows for word prefix search."""
@@ -27,29 +69,48 @@ def startswith(words, indexing, **kwargs):
         result.extend([word[:count].strip(u'-')
                        for count in range(1, len(word)+1)])
     return result
+startswith.tokenwise = True
+
+def edge_ngrams(min_length=1, max_length=None, fields=None):
+    """
+    Returns an indexer for word prefix search which, unlike startswith, only
+    stores prefixes with min_length to max_length characters. Shorter words
+    are stored completely, so they can still be found.
+
+    Search terms longer than max_length get truncated to max_length
+    characters. "fields" restricts prefix indexing to the given fields; the
+    words of all other fields are stored as (truncated) words, only.
+    """
+    def truncate(word):
+        if max_length:
+            return word[:max_length]
+        return word
+
+    def indexer(words, indexing, field_name=None, **kwargs):
+        if not indexing:
+            return [truncate(word) for word in words]
+        result = []
+        for word in words:
+            if fields is not None and field_name not in fields:
+                result.append(truncate(word))
+                continue
+            if len(word) < min_length:
+                result.append(word)
+            end = len(word)
+            if max_length:
+                end = min(end, max_length)
+            result.extend([word[:count].strip(u'-')
+                           for count in range(min_length, end + 1)])
+        return result
+    indexer.tokenwise = True
+    indexer.per_field = True
+    return indexer
 
 def porter_stemmer(words, language, **kwargs):
     """Porter-stemmer in various languages."""
-    languages = [language,]
-    if '-' in language:
-        languages.append(language.split('-')[0])
-
-    # Fall back to English
-    languages.append('en')
-
-    # Find a stemmer for this language
-    for language in languages:
-        try:
-            stem = __import__('search.porter_stemmers.%s' % language,
-                                 {}, {}, ['']).stem
-        except:
-            continue
-        break
-
-    result = []
-    for word in words:
-        result.append(stem(word))
-    return result
+    stem = get_stemmer(language)
+    return [stem(word) for word in words]
+porter_stemmer.tokenwise = True
 
 stop_words = {
     'en': set(('a', 'an', 'and', 'or', 'the', 'these', 'those', 'whose', 'to')),
@@ -68,10 +129,13 @@ def non_stop(words, indexing, language, **kwargs):
     if indexing:
         return words
     return list(set(words) - get_stop_words(language))
+# while indexing no words get removed
+non_stop.tokenwise = True
 
 def porter_stemmer_non_stop(words, **kwargs):
     """Combines porter_stemmer with non_stop."""
     return porter_stemmer(non_stop(words, **kwargs), **kwargs)
+porter_stemmer_non_stop.tokenwise = True
 
 # Language handler
 def site_language(instance, **kwargs):
@@ -87,13 +151,24 @@ def site_language(instance, **kwargs):
     # Fall back to default language
     return settings.LANGUAGE_CODE
 
-def default_splitter(text, indexing=False, **kwargs):
+# Limits for the keywords generated from hyphenated words
+MAX_HYPHENATED_PARTS = getattr(settings, 'SEARCH_MAX_HYPHENATED_PARTS', 8)
+MAX_HYPHENATED_SPAN = getattr(settings, 'SEARCH_MAX_HYPHENATED_SPAN', None)
+# Number of hyphenated words seen while indexing and how many of them hit one
+# of the limits above
+hyphenation_stats = {'words': 0, 'truncated': 0}
+
+def default_splitter(text, indexing=False, max_parts=MAX_HYPHENATED_PARTS,
+        max_span=MAX_HYPHENATED_SPAN, **kwargs):
     """
     Returns an array of  keywords, that are included
     in query. All character besides of letters, numbers
     and '_' are split characters. The character '-' is a special
     case: two words separated by '-' create an additional keyword
     consisting of both words without separation (see example).
+    max_parts and max_span limit these combinations (see
+    get_word_combinations()). Use functools.partial() to configure them per
+    search index.
 
     Examples:
     - text='word1/word2 word3'
@@ -112,22 +187,216 @@ def default_splitter(text, indexing=False, **kwargs):
         if '-' not in word:
             keywords.append(word)
         else:
-            keywords.extend(get_word_combinations(word))
+            keywords.extend(get_word_combinations(word, max_parts, max_span))
     return keywords
 
-def get_word_combinations(word):
+def get_word_combinations(word, max_parts=None, max_span=None):
     """
     'one-two-three'
     =>
     ['one', 'two', 'three', 'onetwo', 'twothree', 'onetwothree']
+
+    Every part is always returned. Only the first max_parts parts get
+    combined and combinations consist of at most max_span parts.
     """
-    permutations = []
     parts = [part for part in word.split(u'-') if part]
-    for count in range(1, len(parts) + 1):
-        for index in range(len(parts) - count + 1):
-            permutations.append(u''.join(parts[index:index+count]))
+    combined = parts
+    span = len(parts)
+    hyphenation_stats['words'] += 1
+    if max_parts and len(parts) > max_parts:
+        combined = parts[:max_parts]
+        span = max_parts
+    if max_span and span > max_span:
+        span = max_span
+    if combined is not parts or span < len(combined):
+        hyphenation_stats['truncated'] += 1
+
+    permutations = list(parts)
+    for count in range(2, span + 1):
+        for index in range(len(combined) - count + 1):
+            permutations.append(u''.join(combined[index:index+count]))
     return permutations
 
+# Search index filters
+_FILTER_OPERATORS = {
+    'exact': lambda value, arg: value == arg,
+    'in': lambda value, arg: value in arg,
+    'lt': lambda value, arg: value < arg,
+    'lte': lambda value, arg: value <= arg,
+    'gt': lambda value, arg: value > arg,
+    'gte': lambda value, arg: value >= arg,
+    'call': lambda value, arg: bool(arg(value)),
+}
+
+def _make_filter_predicate(attr, op, arg):
+    test = _FILTER_OPERATORS[op]
+    if callable(arg) and op != 'call':
+        return lambda values: test(values[attr], arg())
+    return lambda values: test(values[attr], arg)
+
+def compile_filters(filters):
+    """
+    Turns a filters dict like {'check': True, 'rank__gte': 3} into a tuple of
+    the field names it needs and a list of predicates (one per filter). Each
+    predicate takes a mapping of field values. Callable filter values get
+    called on every check and the 'call' operator passes the field value to
+    the callable (e.g., {'title__call': bool}).
+    """
+    field_names = []
+    predicates = []
+    for filter, arg in filters.items():
+        attr, op = filter, 'exact'
+        if '__' in filter:
+            attr, op = filter.rsplit('__', 1)
+        op = op.lower()
+        if op not in _FILTER_OPERATORS:
+            raise ValueError('Invalid search index filter: %s %s' % (filter,
+                                                                    arg))
+        predicates.append(_make_filter_predicate(attr, op, arg))
+        if attr not in field_names:
+            field_names.append(attr)
+    return tuple(field_names), predicates
+
+def _group_words(fields, per_field):
+    # Without "per_field" all values of the document get indexed at once
+    if per_field:
+        return fields
+    return [(None, [value for field_name, values in fields
+                    for value in values])]
+
+def analyze(documents, splitter=default_splitter, indexer=None):
+    """
+    Runs the splitter and indexer on a batch of documents. Each document is a
+    tuple of a list of (field_name, values) pairs and the document's language.
+    Returns a list of terms for each document. The indexer gets called once
+    per document.
+
+    Indexers which treat fields differently can set "per_field = True". Then
+    they get called once per field with the field's name passed in as
+    "field_name".
+
+    Indexers which process every word independently of the others can set
+    "tokenwise = True". Then every distinct (language, field_name, word) of
+    the whole batch passes through the indexer only once.
+    """
+    tokenwise = getattr(indexer, 'tokenwise', False)
+    per_field = getattr(indexer, 'per_field', False)
+    analyzed = {}
+    result = []
+    for fields, language in documents:
+        index = []
+        for field_name, values in _group_words(fields, per_field):
+            kwargs = {}
+            if per_field:
+                kwargs['field_name'] = field_name
+            words = []
+            for value in values:
+                words.extend(splitter(value, indexing=True, language=language))
+            if not indexer:
+                index.extend(words)
+            elif not tokenwise:
+                index.extend(indexer(words, indexing=True, language=language,
+                                     **kwargs))
+            else:
+                for word in words:
+                    key = (language, field_name, word)
+                    if key not in analyzed:
+                        analyzed[key] = indexer([word], indexing=True,
+                            language=language, **kwargs)
+                    index.extend(analyzed[key])
+        result.append(index)
+    return result
+
+def count_terms(document, splitter=default_splitter, indexer=None):
+    """
+    Returns a ({term: frequency}, length) tuple for a document (see
+    analyze()). In contrast to analyze() the terms are built like search
+    words, so they can be looked up with the words of a query.
+
+    Query indexers may drop duplicate words (e.g., non_stop), so "tokenwise"
+    indexers get called for every distinct word and its terms get counted as
+    often as the word occurs.
+    """
+    fields, language = document
+    tokenwise = getattr(indexer, 'tokenwise', False)
+    per_field = getattr(indexer, 'per_field', False)
+    frequencies = {}
+    length = 0
+    for field_name, values in _group_words(fields, per_field):
+        kwargs = {}
+        if per_field:
+            kwargs['field_name'] = field_name
+        words = []
+        for value in values:
+            words.extend(splitter(value, indexing=False, language=language))
+        if indexer and tokenwise:
+            analyzed = {}
+            terms = []
+            for word in words:
+                if word not in analyzed:
+                    analyzed[word] = indexer([word], indexing=False,
+                                             language=language, **kwargs)
+                terms.extend(analyzed[word])
+            words = terms
+        elif indexer:
+            words = indexer(words, indexing=False, language=language,
+                            **kwargs)
+        for word in words:
+            frequencies[word] = frequencies.get(word, 0) + 1
+            length += 1
+    return frequencies, length
+
+_TERM_ESCAPES = {u'\\': u'\\\\', u' ': u'\\s'}
+_TERM_UNESCAPES = dict((escaped[1], char)
+                       for char, escaped in _TERM_ESCAPES.items())
+_TERM_ESCAPE_REGEX = re.compile(r'[\\ ]')
+_TERM_UNESCAPE_REGEX = re.compile(r'\\(.)')
+
+def encode_term_frequencies(frequencies, length):
+    """
+    Encodes term frequencies as "length term:frequency ...". Terms can contain
+    spaces (e.g., via comma_splitter), so spaces and backslashes get escaped.
+    """
+    return u' '.join([unicode(length)] + [u'%s:%d' % (
+        _TERM_ESCAPE_REGEX.sub(lambda match: _TERM_ESCAPES[match.group()],
+                               term), frequency)
+        for term, frequency in sorted(frequencies.items())])
+
+def decode_term_frequencies(value):
+    """Returns the ({term: frequency}, length) tuple of an encoded value."""
+    if not value:
+        return {}, 0
+    items = value.split(u' ')
+    frequencies = {}
+    for item in items[1:]:
+        term, frequency = item.rsplit(u':', 1)
+        term = _TERM_UNESCAPE_REGEX.sub(
+            lambda match: _TERM_UNESCAPES.get(match.group(1), match.group()),
+            term)
+        frequencies[term] = int(frequency)
+    return frequencies, int(items[0])
+
+def bm25(frequencies, length, document_frequencies, document_count,
+        average_length, k1=None, b=None):
+    """
+    Returns the BM25 score of a document with the given term frequencies
+    and length for the search words in document_frequencies.
+    """
+    if k1 is None:
+        k1 = BM25_K1
+    if b is None:
+        b = BM25_B
+    score = 0.0
+    for word, document_frequency in document_frequencies.items():
+        frequency = frequencies.get(word, 0)
+        if not frequency:
+            continue
+        idf = math.log(1 + (document_count - document_frequency + 0.5) /
+                           (document_frequency + 0.5))
+        score += idf * frequency * (k1 + 1) / (frequency + k1 * (
+            1 - b + b * length / average_length))
+    return score
+
 class DictEmu(object):
     def __init__(self, data):
         self.data = data
@@ -143,31 +412,55 @@ class IndexField(ListField):
         super(IndexField, self).__init__(*args, **kwargs)
 
     def pre_save(self, model_instance, add):
-        if self.search_manager.filters and not \
+        if self.search_manager._filter_predicates and not \
                 self.search_manager.should_index(DictEmu(model_instance)):
             return []
 
+        prepared = model_instance.__dict__.get('_prepared_search_index', {})
+        if self.attname in prepared:
+            index = prepared.pop(self.attname)
+        else:
+            index = analyze([self.get_document(model_instance)],
+                self.search_manager.splitter, self.search_manager.indexer)[0]
+        # Sort index to make debugging easier and don't store duplicates
+        index = sorted(set(index))
+        setattr(model_instance, self.search_manager.search_list_field_name,
+            index)
+        return index
+
+    def get_document(self, model_instance):
+        """
+        Returns the values to index per field and their language as a tuple
+        suitable for analyze().
+        """
         language = self.search_manager.language
         if callable(language):
             language = language(model_instance, property=self)
 
-        index = []
+        document = []
         for field_name in self.search_manager.fields_to_index:
             values = getattr_by_path(model_instance, field_name, None)
             if not values:
                 values = ()
             elif not isinstance(values, (list, tuple)):
                 values = (values,)
-            for value in values:
-                index.extend(self.search_manager.splitter(value, indexing=True,
-                    language=language))
-        if self.search_manager.indexer:
-            index = self.search_manager.indexer(index, indexing=True,
-                language=language)
-        # Sort index to make debugging easier
-        setattr(model_instance, self.search_manager.search_list_field_name,
-            sorted(set(index)))
-        return index
+            document.append((field_name, values))
+        return document, language
+
+    def prepare(self, model_instances):
+        """
+        Analyzes a whole batch of instances at once, so pre_save() doesn't
+        have to analyze them one by one.
+        """
+        model_instances = [model_instance for model_instance in model_instances
+            if not self.search_manager._filter_predicates or
+                self.search_manager.should_index(DictEmu(model_instance))]
+        indexes = analyze([self.get_document(model_instance)
+                           for model_instance in model_instances],
+            self.search_manager.splitter, self.search_manager.indexer)
+        for model_instance, index in zip(model_instances, indexes):
+            model_instance.__dict__.setdefault('_prepared_search_index', {})[
+                self.attname] = index
 
 class SearchManager(models.Manager):
     """
@@ -179,15 +472,33 @@ class SearchManager(models.Manager):
     so they can be searched, too.
 
     With "filters" you can specify when a values index should be created.
+    Entities matching all of the "exclude" filters don't get indexed.
+
+    With "term_dictionary" the manager keeps track of all indexed terms and
+    their document frequencies (see search.models.IndexTerm), which allows
+    for prefix search without storing prefixes.
+
+    With "cache_timeout" (default: settings.SEARCH_CACHE_TIMEOUT) the results
+    of relation index searches get cached. Every index update invalidates all
+    cached results of the manager.
+
+    With "scoring" the relation index additionally stores the frequencies of
+    the terms and the length of each entity, so search(..., ranked=True) can
+    rank the results by their BM25 score. This requires a term dictionary.
+
+    With "term_filter" searches for terms which aren't indexed at all return
+    no results without querying the index. The filter has to be built via
+    rebuild_term_filter() (e.g., periodically via the
+    rebuild_search_term_filters command) and index updates adding new terms
+    make it stale until the next rebuild.
     """
     def __init__(self, fields_to_index, indexer=None, splitter=default_splitter,
             relation_index=True, integrate='*', filters={},
-            language=site_language, **kwargs):
+            language=site_language, exclude={}, term_dictionary=False,
+            cache_timeout=None, term_filter=False, scoring=False, **kwargs):
         # integrate should be specified when using the relation index otherwise
         # we doublicate the amount of data in the datastore and the relation
         # index makes no sense any more
-        # TODO: filters has to be extended (maybe a function) to allow Django's
-        # QuerySet methods like exclude
         if integrate is None:
             integrate = ()
         if integrate == '*' and not relation_index:
@@ -198,13 +509,37 @@ class SearchManager(models.Manager):
         if isinstance(integrate, basestring):
             integrate = (integrate,)
         self.filters = filters
+        self.exclude = exclude
+        # Compile filters once instead of parsing them on every save
+        self._filter_fields, self._filter_predicates = compile_filters(filters)
+        if exclude:
+            exclude_fields, exclude_predicates = compile_filters(exclude)
+            self._filter_fields += tuple(field_name
+                for field_name in exclude_fields
+                if field_name not in self._filter_fields)
+            self._filter_predicates.append(lambda values: not all(
+                predicate(values) for predicate in exclude_predicates))
         self.integrate = integrate
         self.splitter = splitter
         self.indexer = indexer
         self.language = language
         self.relation_index = relation_index
+        self.term_dictionary = term_dictionary
+        if cache_timeout is None:
+            cache_timeout = getattr(settings, 'SEARCH_CACHE_TIMEOUT', None)
+        self.cache_timeout = cache_timeout
+        self.term_filter = term_filter
+        self.scoring = scoring
+        # (generation, filter) tuple of the last check, see get_term_filter()
+        self._term_filter = None
         if len(fields_to_index) == 0:
             raise ValueError('No fields specified for index!')
+        if term_dictionary and not relation_index:
+            raise ValueError('The term dictionary requires a relation index!')
+        if term_filter and not relation_index:
+            raise ValueError('The term filter requires a relation index!')
+        if scoring and not term_dictionary:
+            raise ValueError('Scoring requires a term dictionary!')
         # search_list_field_name will be set if no relation_index is used that is
         # for relation_index=False or for the relation_index_model itself
         self.search_list_field_name = ''
@@ -225,6 +560,15 @@ class SearchManager(models.Manager):
             getattr(model, self.search_list_field_name).contribute_to_class(
                 model, self.search_list_field_name)
 
+    def get_index_field(self):
+        """Returns the IndexField storing this manager's search terms."""
+        if self.relation_index:
+            model = self._relation_index_model
+            manager = getattr(model, self.name)
+        else:
+            model, manager = self.model, self
+        return model._meta.get_field(manager.search_list_field_name)
+
     def filter(self, values):
         """
         Returns a query for the given values (creates '=' filters for the
@@ -233,12 +577,17 @@ class SearchManager(models.Manager):
         if not isinstance(values, (tuple, list)):
             values = (values,)
         filtered = self.model.objects.all()
-        for value in set(values):
+        # Keep the given order, so the most selective filters come first
+        seen = set()
+        for value in values:
+            if value in seen:
+                continue
+            seen.add(value)
             filter = {self.search_list_field_name:value}
             filtered = filtered.filter(**filter)
         return filtered
 
-    def _search(self, query, indexer=None, splitter=None,
+    def _get_words(self, query, indexer=None, splitter=None,
             language=settings.LANGUAGE_CODE):
         if not splitter:
             splitter = default_splitter
@@ -249,6 +598,11 @@ class SearchManager(models.Manager):
         words = set(words)
         if len(words) >= 4:
             words -= get_stop_words(language)
+        return words
+
+    def _search(self, query, indexer=None, splitter=None,
+            language=settings.LANGUAGE_CODE):
+        words = self._get_words(query, indexer, splitter, language)
         # Don't allow empty queries
         if not words and query:
             # This query will never find anything
@@ -259,56 +613,388 @@ class SearchManager(models.Manager):
         # Check if filter doesn't match
         if not values:
             return False
-        for filter, value in self.filters.items():
-            attr, op = filter, 'exact'
-            if '__' in filter:
-                attr, op = filter.rsplit('__', 1)
-            op = op.lower()
-            if (op == 'exact' and values[attr] != value or
-#                    op == '!=' and values[attr] == value or
-                    op == 'in' and values[attr] not in value or
-                    op == 'lt' and values[attr] >= value or
-                    op == 'lte' and values[attr] > value or
-                    op == 'gt' and values[attr] <= value or
-                    op == 'gte' and values[attr] < value):
+        for predicate in self._filter_predicates:
+            if not predicate(values):
                 return False
-            elif op not in ('exact', 'in', 'lt', 'lte', 'gte', 'gt'):
-                raise ValueError('Invalid search index filter: %s %s' % (filter, value))
         return True
 
 #    @commit_locked
-    def update_relation_index(self, parent_pk, delete=False):
+    def update_relation_index(self, parent_pk, delete=False, parent=None):
+        """
+        Updates the relation index entity of the given parent. If the saved
+        "parent" instance is passed in it's used instead of re-fetching it.
+        """
         relation_index_model = self._relation_index_model
-        try:
-            index = relation_index_model.objects.get(pk=parent_pk)
-        except ObjectDoesNotExist:
-            index = None
-
+        values = None
         if not delete:
-            try:
-                parent = self.model.objects.get(pk=parent_pk)
-            except ObjectDoesNotExist:
-                parent = None
+            if parent is None:
+                try:
+                    parent = self.model.objects.get(pk=parent_pk)
+                except ObjectDoesNotExist:
+                    parent = None
 
-            values = None
             if parent:
                 values = self.get_index_values(parent)
 
+        old_terms = old_length = None
+        if self.term_dictionary:
+            old_terms, old_length = self._get_stored_terms([parent_pk]).get(
+                parent_pk, (None, None))
+
         # Remove index if it's not needed, anymore
         if delete or not self.should_index(values):
-            if index:
-                index.delete()
+            relation_index_model.objects.filter(pk=parent_pk).delete()
+            self.invalidate_cache()
+            if self.term_dictionary:
+                self._update_term_dictionary([(old_terms, None)],
+                                             -(old_length or 0))
             return
 
-        # Update/create index
-        if not index:
-            index = relation_index_model(pk=parent_pk, **values)
+        # Update/create index. The index entity consists of nothing but the
+        # values collected above, so we don't have to load the old one.
+        index = relation_index_model(pk=parent_pk, **values)
 
         # This guarantees that we also set virtual @properties
         for key, value in values.items():
             setattr(index, key, value)
+        length = self._set_term_frequencies(index)
 
         index.save()
+        self.invalidate_cache()
+        self._check_term_filter(getattr(index, self.get_index_field().attname))
+
+        if self.term_dictionary:
+            self._update_term_dictionary([(old_terms,
+                getattr(index, self.get_index_field().attname))],
+                length - (old_length or 0))
+
+    def update_relation_indexes(self, parent_pks, parents=None,
+            rebuild=False):
+        """
+        Batch version of update_relation_index(). The parents get fetched with
+        a single query (unless they're passed in via "parents"). With
+        bulk_create() the index entities get written in batches, otherwise
+        they get saved one by one.
+
+        With "rebuild" the term dictionary ignores the old index entities
+        (see reset_term_dictionary()).
+        """
+        parent_pks = list(parent_pks)
+        if not parent_pks:
+            return
+        relation_index_model = self._relation_index_model
+        if parents is None:
+            parents = in_bulk(self.model, parent_pks)
+        else:
+            parents = dict((parent.pk, parent) for parent in parents)
+
+        stored = {}
+        if self.term_dictionary and not rebuild:
+            stored = self._get_stored_terms(parent_pks)
+        length_delta = -sum([length or 0 for terms, length in stored.values()])
+
+        indexes = []
+        stale_pks = []
+        for parent_pk in parent_pks:
+            values = None
+            if parent_pk in parents:
+                values = self.get_index_values(parents[parent_pk])
+            if not self.should_index(values):
+                stale_pks.append(parent_pk)
+                continue
+            index = relation_index_model(pk=parent_pk, **values)
+            # This guarantees that we also set virtual @properties
+            for key, value in values.items():
+                setattr(index, key, value)
+            length_delta += self._set_term_frequencies(index)
+            indexes.append(index)
+
+        # Analyze the whole batch at once
+        index_field = self.get_index_field()
+        index_field.prepare(indexes)
+
+        for chunk in chunked(stale_pks):
+            relation_index_model.objects.filter(pk__in=chunk).delete()
+        if hasattr(relation_index_model.objects, 'bulk_create'):
+            if self.term_dictionary and not rebuild:
+                existing = set(stored)
+            else:
+                existing = set(self._get_existing_pks(
+                    [index.pk for index in indexes]))
+            # bulk_create() only inserts, so existing entities get replaced
+            # chunk by chunk. They're only missing from searches between the
+            # delete and the insert of their own chunk.
+            for chunk in chunked(indexes):
+                replaced = [index.pk for index in chunk
+                            if index.pk in existing]
+                if replaced:
+                    relation_index_model.objects.filter(
+                        pk__in=replaced).delete()
+                relation_index_model.objects.bulk_create(chunk)
+        else:
+            # Without bulk_create() every entity needs its own write
+            for index in indexes:
+                index.save()
+        self.invalidate_cache()
+        self._check_term_filter(term for index in indexes
+                                for term in getattr(index, index_field.attname))
+
+        if self.term_dictionary:
+            new_terms = dict((index.pk, getattr(index, index_field.attname))
+                             for index in indexes)
+            self._update_term_dictionary([(stored.get(parent_pk, (None,))[0],
+                                           new_terms.get(parent_pk))
+                                          for parent_pk in parent_pks],
+                                         length_delta)
+
+    def _get_generation_key(self):
+        return 'search-generation:%s' % self.index_name
+
+    def get_cache_generation(self):
+        """
+        Returns the random token cached results of this manager are stored
+        under. A missing token (e.g., after eviction) results in a new one, so
+        results cached under an old token can never come back.
+        """
+        key = self._get_generation_key()
+        generation = cache.get(key)
+        if generation is None:
+            cache.add(key, uuid.uuid4().hex, self.cache_timeout)
+            generation = cache.get(key)
+        return generation
+
+    def invalidate_cache(self):
+        """Makes all cached search results of this manager stale."""
+        if not self.cache_timeout:
+            return
+        cache.set(self._get_generation_key(), uuid.uuid4().hex,
+                  self.cache_timeout)
+
+    def _get_existing_pks(self, parent_pks):
+        pks = []
+        for chunk in chunked(parent_pks):
+            pks.extend(self._relation_index_model.objects.filter(
+                pk__in=chunk).values_list('pk', flat=True))
+        return pks
+
+    def _get_stored_terms(self, parent_pks):
+        """
+        Returns {pk: (terms, length)} for the stored index entities of the
+        given parents. The length is None unless "scoring" is enabled.
+        """
+        field_names = [self.get_index_field().attname]
+        if self.scoring:
+            field_names.append(self.term_frequencies_field_name)
+        stored = {}
+        for chunk in chunked(parent_pks):
+            for row in self._relation_index_model.objects.filter(
+                    pk__in=chunk).values_list('pk', *field_names):
+                length = None
+                if self.scoring:
+                    length = decode_term_frequencies(row[2])[1]
+                stored[row[0]] = (row[1], length)
+        return stored
+
+    def _set_term_frequencies(self, index):
+        """
+        Stores the term frequencies of the given index entity in it and
+        returns its length.
+        """
+        if not self.scoring:
+            return 0
+        frequencies, length = count_terms(
+            self.get_index_field().get_document(index), self.splitter,
+            self.indexer)
+        setattr(index, self.term_frequencies_field_name,
+                encode_term_frequencies(frequencies, length))
+        return length
+
+    def _get_term_frequencies(self, pks):
+        """Returns (pk, stored term frequencies) tuples in the given order."""
+        stored = {}
+        for start in range(0, len(pks), IN_QUERY_LIMIT):
+            stored.update(self._relation_index_model.objects.filter(
+                pk__in=pks[start:start + IN_QUERY_LIMIT]).values_list(
+                'pk', self.term_frequencies_field_name))
+        return [(pk, stored[pk]) for pk in pks if pk in stored]
+
+    def score(self, candidates, words):
+        """
+        Ranks (pk, stored term frequencies) tuples by their BM25 score for the
+        given search words. Returns (pk, score) tuples, best match first.
+        """
+        document_frequencies = self.get_document_frequencies(words)
+        statistics = IndexStatistics.objects.get_for_index(self.index_name)
+        document_count = max(statistics.document_count, 1)
+        average_length = float(statistics.total_length) / document_count or 1.0
+        scores = []
+        for pk, stored in candidates:
+            frequencies, length = decode_term_frequencies(stored)
+            scores.append((pk, bm25(frequencies, length, document_frequencies,
+                                    document_count, average_length)))
+        # Stable sort: equally scored matches keep the index order
+        scores.sort(key=lambda item: -item[1])
+        return scores
+
+    def _update_term_dictionary(self, changes, length_delta=0):
+        """
+        Updates the document frequencies for a list of (old_terms, new_terms)
+        tuples (one per changed entity). None stands for a missing entity.
+        length_delta is the change of the total document length.
+        """
+        deltas = {}
+        document_delta = 0
+        for old_terms, new_terms in changes:
+            if old_terms is None and new_terms is not None:
+                document_delta += 1
+            elif old_terms is not None and new_terms is None:
+                document_delta -= 1
+            old_terms, new_terms = set(old_terms or ()), set(new_terms or ())
+            for term in new_terms - old_terms:
+                deltas[term] = deltas.get(term, 0) + 1
+            for term in old_terms - new_terms:
+                deltas[term] = deltas.get(term, 0) - 1
+        IndexTerm.objects.update_frequencies(self.index_name, deltas,
+                                             document_delta, length_delta)
+
+    def reset_term_dictionary(self):
+        """Removes all terms. Rebuild the index afterwards."""
+        IndexTerm.objects.filter(index_name=self.index_name).delete()
+        IndexStatistics.objects.delete_for_index(self.index_name)
+
+    def _get_term_filter_keys(self):
+        return ('search-term-filter:%s' % self.index_name,
+                'search-term-filter-generation:%s' % self.index_name)
+
+    def get_term_filter(self):
+        """
+        Returns the BloomFilter of all indexed terms or None if there's no
+        up-to-date filter.
+        """
+        filter_key, generation_key = self._get_term_filter_keys()
+        generation = cache.get(generation_key)
+        # Only fetch the filter again if it changed since the last check
+        if self._term_filter is None or self._term_filter[0] != generation:
+            term_filter = None
+            stored = cache.get(filter_key)
+            if generation is not None and stored is not None and \
+                    stored[0] == generation:
+                term_filter = stored[1]
+            self._term_filter = (generation, term_filter)
+        return self._term_filter[1]
+
+    def rules_out(self, terms):
+        """
+        Returns True if the term filter proves that one of the terms isn't
+        indexed.
+        """
+        if not self.term_filter:
+            return False
+        term_filter = self.get_term_filter()
+        if term_filter is None:
+            return False
+        for term in terms:
+            if term not in term_filter:
+                return True
+        return False
+
+    def _check_term_filter(self, terms):
+        """Makes the term filter stale if it's missing one of the terms."""
+        if not self.term_filter:
+            return
+        term_filter = self.get_term_filter()
+        for term in terms:
+            if term_filter is None or term not in term_filter:
+                cache.set(self._get_term_filter_keys()[1], uuid.uuid4().hex,
+                          TERM_FILTER_TIMEOUT)
+                return
+
+    def rebuild_term_filter(self, batch_size=ITERATOR_BATCH_SIZE):
+        """
+        Builds a new filter from all indexed terms. Returns False if the index
+        got new terms in the meantime, so the new filter is stale already.
+        """
+        filter_key, generation_key = self._get_term_filter_keys()
+        # Invalidate the old filter, so all updates during the rebuild make
+        # the new one stale
+        generation = uuid.uuid4().hex
+        cache.set(generation_key, generation, TERM_FILTER_TIMEOUT)
+        terms = set()
+        if self.term_dictionary:
+            key_prefix = IndexTerm.get_key(self.index_name, u'')
+            for pk in stream_keys(IndexTerm.objects.filter(
+                    index_name=self.index_name), batch_size):
+                terms.add(pk[len(key_prefix):])
+        else:
+            for pk, index_terms in stream_rows(
+                    self._relation_index_model.objects.all(),
+                    (self.get_index_field().attname,), batch_size):
+                terms.update(index_terms)
+        term_filter = BloomFilter(len(terms), TERM_FILTER_ERROR_RATE)
+        for term in terms:
+            term_filter.add(term)
+        cache.set(filter_key, (generation, term_filter), TERM_FILTER_TIMEOUT)
+        self._term_filter = None
+        return self.get_term_filter() is not None
+
+    def get_document_frequencies(self, terms):
+        """Returns a {term: document frequency} dict for the given terms."""
+        keys = dict((IndexTerm.get_key(self.index_name, term), term)
+                    for term in terms)
+        frequencies = dict((term, 0) for term in terms)
+        for key, index_term in in_bulk(IndexTerm, keys.keys()).items():
+            frequencies[keys[key]] = index_term.document_frequency
+        return frequencies
+
+    def plan_words(self, words):
+        """
+        Orders the search words by their document frequency (rarest first),
+        so the most selective filters come first, and drops words occurring
+        in nearly every entity (see COMMON_TERM_RATIO). The frequencies are
+        maintained without transactions, so they're only used for ordering
+        and never to rule out matches.
+        """
+        frequencies = self.get_document_frequencies(words)
+        words = sorted(words, key=lambda word: (frequencies[word], word))
+        if words and COMMON_TERM_RATIO is not None:
+            document_count = IndexStatistics.objects.get_for_index(
+                self.index_name).document_count
+            # Keep at least the rarest word
+            words = words[:1] + [word for word in words[1:]
+                if frequencies[word] <= COMMON_TERM_RATIO * document_count]
+        return words
+
+    def expand_prefix(self, prefix, limit=PREFIX_EXPANSION_LIMIT):
+        """
+        Returns the (at most "limit") most frequent terms starting with the
+        given prefix.
+        """
+        terms = IndexTerm.objects.filter(index_name=self.index_name,
+            term__gte=prefix, term__lt=prefix + u'\ufffd').order_by('term')
+        terms = sorted(terms[:PREFIX_SCAN_LIMIT],
+            key=lambda term: -term.document_frequency)
+        return [term.term for term in terms[:limit]]
+
+    def get_index_fingerprint(self, parent):
+        """
+        Returns a compact digest of the values the relation index of the given
+        parent gets built from.
+        """
+        return md5(repr(sorted(self.get_index_values(parent).items()))).digest()
+
+    def snapshot_index_values(self, parent):
+        """
+        Remembers a fingerprint of the values the relation index of the given
+        parent was built from, so unrelated saves can skip the index update.
+        """
+        snapshots = parent.__dict__.setdefault('_search_index_values', {})
+        snapshots[self.name] = self.get_index_fingerprint(parent)
+
+    def index_values_changed(self, parent):
+        snapshot = parent.__dict__.get('_search_index_values', {}).get(
+            self.name)
+        return snapshot is None or \
+            snapshot != self.get_index_fingerprint(parent)
 
     def create_index_model(self):
         attrs = dict(__module__=self.__module__)
@@ -344,25 +1030,25 @@ class SearchManager(models.Manager):
             models.Model.__init__(self, *args, **kwargs)
         attrs['__init__'] = __init__
 
-        self._relation_index_model = type(
-            'RelationIndex_%s_%s_%s' % (self.model._meta.app_label,
-                                        self.model._meta.object_name,
-                                        self.name),
-            (models.Model,), attrs)
+        if self.scoring:
+            # Unindexed, so storing the frequencies stays cheap
+            self.term_frequencies_field_name = '%s_term_frequencies' % self.name
+            attrs[self.term_frequencies_field_name] = models.TextField(
+                null=True, editable=False)
+
+        self.index_name = 'RelationIndex_%s_%s_%s' % (
+            self.model._meta.app_label, self.model._meta.object_name,
+            self.name)
+        self._relation_index_model = type(self.index_name, (models.Model,),
+                                          attrs)
         self._relation_index_model.add_to_class(self.name, SearchManager(
             self.fields_to_index, splitter=self.splitter, indexer=self.indexer,
             language=self.language, relation_index=False))
 
     def get_index_values(self, parent):
-        filters = []
-        for filter in self.filters.keys():
-            if '__' in filter:
-                filters.append(filter.rsplit('__')[0])
-            else:
-                filters.append(filter)
-        filters = tuple(filters)
         values = {}
-        for field_name in set(self.fields_to_index + self.integrate + filters):
+        for field_name in set(self.fields_to_index + self.integrate +
+                              self._filter_fields):
             field = self.model._meta.get_field_by_name(field_name)[0]
             if isinstance(field, models.ForeignKey):
                 value = field.pre_save(parent, False)
@@ -377,14 +1063,126 @@ class SearchManager(models.Manager):
                 values[field_name] = value
         return values
 
-    def search(self, query, language=settings.LANGUAGE_CODE):
+    def search(self, query, language=settings.LANGUAGE_CODE, prefix=False,
+            cursor=None, operator='and', minimum_should_match=None,
+            ranked=False):
+        """
+        Searches for entities containing all words of the query. With
+        "prefix" the last word of the query is treated as a prefix which gets
+        expanded to the most frequent matching terms of the term dictionary.
+
+        "cursor" continues a relation index search where a previous one ended
+        (see RelationIndexQuery.next_cursor).
+
+        With operator='or' entities containing at least minimum_should_match
+        (default: 1) of the words match, so values larger than the number of
+        distinct words match nothing. The results are ordered by the number of
+        matching words (see TermMergeQuery).
+
+        With "ranked" the results are ordered by their BM25 score (see
+        ScoredQuery). This requires "scoring".
+        """
+        if operator not in ('and', 'or'):
+            raise ValueError('Unknown search operator: %r' % operator)
+        if prefix and not self.term_dictionary:
+            raise ValueError('Prefix search requires a term dictionary!')
+        if cursor and not self.relation_index:
+            raise ValueError('Cursors require a relation index!')
+        if operator == 'or':
+            if not self.relation_index:
+                raise ValueError('OR search requires a relation index!')
+            if prefix or cursor:
+                raise ValueError('OR search supports neither prefixes nor '
+                                 'cursors!')
+        elif minimum_should_match is not None:
+            raise ValueError('minimum_should_match requires operator="or"!')
+        if ranked:
+            if not self.scoring:
+                raise ValueError('Ranked search requires scoring!')
+            if prefix or cursor:
+                raise ValueError('Ranked search supports neither prefixes '
+                                 'nor cursors!')
         if self.relation_index:
-            items = getattr(self._relation_index_model, self.name).search(query,
-                language=language).values('pk')
-            return RelationIndexQuery(self.model, items)
+            index_manager = getattr(self._relation_index_model, self.name)
+            words = index_manager._get_words(query, index_manager.indexer,
+                index_manager.splitter, language)
+            if operator == 'or' and words:
+                results = self._or_search(words, minimum_should_match)
+                if ranked:
+                    return ScoredQuery(self.model, results, self, words)
+                return results
+            if prefix:
+                items = self._prefix_search(query, language)
+            elif words and self.rules_out(words):
+                items = index_manager.none()
+            elif self.term_dictionary and words:
+                planned_words = self.plan_words(words)
+                if MAX_TERM_FILTERS and not cursor and \
+                        len(planned_words) > MAX_TERM_FILTERS:
+                    # The first query combines the rarest words, so it drives
+                    # the merge
+                    merged = TermMergeQuery(self.model,
+                        [index_manager.filter(
+                            planned_words[:MAX_TERM_FILTERS])] +
+                        [index_manager.filter([word])
+                         for word in planned_words[MAX_TERM_FILTERS:]])
+                    if ranked:
+                        return ScoredQuery(self.model, merged, self, words)
+                    return merged
+                else:
+                    items = index_manager.filter(planned_words)
+            else:
+                items = index_manager.search(query, language=language)
+            cache_key = None
+            if self.cache_timeout:
+                if prefix:
+                    key = ('prefix', tuple(self.splitter(query,
+                        indexing=False, language=language)))
+                else:
+                    key = ('and', tuple(sorted(words)))
+                if not key[1]:
+                    # Empty queries match everything, but queries without
+                    # any words (e.g., only punctuation) match nothing
+                    key += (bool(query),)
+                cache_key = [self.index_name, key, language]
+            # Only fetch the keys, so backends can use keys-only queries
+            results = RelationIndexQuery(self.model,
+                items.values_list('pk', flat=True), cursor=cursor,
+                search_manager=self, cache_key=cache_key)
+            if ranked and words:
+                return ScoredQuery(self.model, results, self, words)
+            return results
         return self._search(query, splitter=self.splitter,
             indexer=self.indexer, language=language)
 
+    def _or_search(self, words, minimum_should_match=None):
+        index_manager = getattr(self._relation_index_model, self.name)
+        if minimum_should_match is None:
+            minimum_should_match = 1
+        # Words which aren't indexed can't contribute any matches, but they
+        # still count as non-matching words
+        words = [word for word in sorted(words) if not self.rules_out([word])]
+        return TermMergeQuery(self.model,
+            [index_manager.filter([word]) for word in words],
+            minimum_should_match=minimum_should_match, rank_by_matches=True)
+
+    def _prefix_search(self, query, language):
+        index_manager = getattr(self._relation_index_model, self.name)
+        words = self.splitter(query, indexing=False, language=language)
+        if not words:
+            return index_manager.search(query, language=language)
+        words, prefix = words[:-1], words[-1]
+        if self.indexer:
+            words = self.indexer(words, indexing=False, language=language)
+        if self.rules_out(words):
+            return index_manager.none()
+        terms = self.expand_prefix(prefix)
+        if not terms:
+            # This query will never find anything
+            return index_manager.filter(' ')
+        return index_manager.filter(sorted(set(words))).filter(**{
+            index_manager.search_list_field_name + '__in': terms})
+
 def load_backend():
     backend = getattr(settings, 'SEARCH_BACKEND', 'search.backends.immediate_update')
     import_list = []
@@ -392,12 +1190,46 @@ def load_backend():
         import_list = [backend.rsplit('.', 1)[1]]
     return __import__(backend, globals(), locals(), import_list)
 
+def backend_accepts_instance(backend):
+    """
+    Returns whether the backend's update_relation_index() takes the saved
+    instance. Custom backends may still use the old
+    update_relation_index(search_manager, parent_pk, delete) signature.
+    """
+    args, varargs, keywords, defaults = inspect.getargspec(
+        backend.update_relation_index)
+    return keywords is not None or 'instance' in args
+
 def post(delete, sender, instance, **kwargs):
     for counter, manager_name, manager in sender._meta.concrete_managers:
         if isinstance(manager, SearchManager):
             if manager.relation_index:
+                # Skip saves which didn't touch any of the indexed fields
+                if not delete and not kwargs.get('created') and \
+                        not manager.index_values_changed(instance):
+                    continue
                 backend = load_backend()
-                backend.update_relation_index(manager, instance.pk, delete)
+                if backend_accepts_instance(backend):
+                    backend.update_relation_index(manager, instance.pk, delete,
+                        instance=instance)
+                else:
+                    backend.update_relation_index(manager, instance.pk, delete)
+                if not delete:
+                    manager.snapshot_index_values(instance)
+
+def post_init(sender, instance, **kwargs):
+    # Only instances loaded from the database have an index to compare with
+    if instance.pk is None:
+        return
+    for counter, manager_name, manager in sender._meta.concrete_managers:
+        if isinstance(manager, SearchManager) and manager.relation_index:
+            manager.snapshot_index_values(instance)
+
+def pre_save(sender, instance, **kwargs):
+    # New instances could overwrite an existing entity with a different index,
+    # so their snapshot (taken in the constructor) isn't reliable
+    if instance._state.adding:
+        instance.__dict__.pop('_search_index_values', None)
 
 def post_save(sender, instance, **kwargs):
     post(False, sender, instance, **kwargs)
@@ -413,13 +1245,55 @@ def install_index_model(sender, **kwargs):
             manager.create_index_model()
             needs_relation_index = True
     if needs_relation_index:
+        signals.post_init.connect(post_init, sender=sender)
+        signals.pre_save.connect(pre_save, sender=sender)
         signals.post_save.connect(post_save, sender=sender)
         signals.post_delete.connect(post_delete, sender=sender)
 #signals.class_prepared.connect(install_index_model)
 
+def chunked(items, size=IN_QUERY_LIMIT):
+    """
+    Splits the items into lists of at most "size" items, so the backend's
+    limit for "pk__in" queries doesn't get exceeded.
+    """
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def in_bulk(model, pks):
+    """Like QuerySet.in_bulk(), but splits the pks into chunks."""
+    result = {}
+    for chunk in chunked(pks):
+        result.update(model._default_manager.in_bulk(chunk))
+    return result
+
+def fetch_in_order(model, pks):
+    """
+    Returns the entities with the given pks in the same order. Entities
+    which don't exist (anymore) are left out.
+    """
+    entities = in_bulk(model, pks)
+    return [entities[pk] for pk in pks if pk in entities]
+
 class QueryTraits(object):
     def __iter__(self):
-        return iter(self[:301])
+        return self.iterator()
+
+    def iterator(self, batch_size=ITERATOR_BATCH_SIZE):
+        """
+        Yields all results, fetching and hydrating batch_size results at a
+        time.
+        """
+        start = 0
+        while True:
+            # Index entities without parents don't get hydrated, so only the
+            # number of keys tells whether this was the last batch
+            pks = self.keys(slice(start, start + batch_size))
+            for item in fetch_in_order(self.model, pks):
+                yield item
+            if len(pks) < batch_size:
+                return
+            start += batch_size
 
     def __len__(self):
         return self.count()
@@ -430,41 +1304,368 @@ class QueryTraits(object):
             return result[0]
         raise ObjectDoesNotExist
 
+def _normalize_cache_value(value):
+    if isinstance(value, models.Model):
+        return (value._meta.app_label, value._meta.object_name, value.pk)
+    if isinstance(value, (list, tuple, set)):
+        return [_normalize_cache_value(item) for item in value]
+    return value
+
+def encode_cursor(kind, value):
+    return base64.urlsafe_b64encode('%s:%s' % (kind, value))
+
+def decode_cursor(cursor):
+    try:
+        kind, value = base64.urlsafe_b64decode(str(cursor)).split(':', 1)
+        if kind == 'o':
+            value = int(value)
+        elif kind != 'c':
+            raise ValueError
+    except (TypeError, ValueError):
+        raise ValueError('Invalid search cursor: %r' % cursor)
+    return kind, value
+
 class RelationIndexQuery(QueryTraits):
     """Combines the results of multiple queries by appending the queries in the
-    given order."""
-    def __init__(self, model, query):
+    given order.
+
+    Slices start at the cursor (if any). After fetching a slice "next_cursor"
+    contains an opaque string pointing to the end of the slice. On App Engine
+    it's a datastore cursor, so deep pages cost as much as the first one.
+    Other backends fall back to offsets."""
+    def __init__(self, model, query, cursor=None, search_manager=None,
+            cache_key=None):
         self.model = model
         self.query = query
+        self.cursor = cursor
+        self.next_cursor = None
+        # The search manager caches results if a cache_key is given
+        self.search_manager = search_manager
+        self.cache_key = cache_key
+
+    def with_cursor(self, cursor):
+        self.cursor = cursor
+        return self
 
     def order_by(self, *args, **kwargs):
         self.query = self.query.order_by(*args, **kwargs)
+        if self.cache_key is not None:
+            self.cache_key = self.cache_key + [('order_by', args)]
         return self
 
     def filter(self, *args, **kwargs):
         self.query = self.query.filter(*args, **kwargs)
+        if args:
+            # Q objects can't be turned into cache keys reliably
+            self.cache_key = None
+        elif self.cache_key is not None:
+            self.cache_key = self.cache_key + [('filter', sorted(
+                (key, _normalize_cache_value(value))
+                for key, value in kwargs.items()))]
         return self
 
     def __getitem__(self, index):
-        pks_slice = index
-        if not isinstance(index, slice):
-            pks_slice = slice(None, index + 1, None)
-
-        pks = [instance.pk if isinstance(instance, models.Model) else instance['pk']
-                for instance in self.query[pks_slice]]
-        if not isinstance(index, slice):
-            return self.model.objects.filter(pk__in=pks)[index]
-        return self.model.objects.filter(pk__in=pks)[pks_slice]
-#        return [item for item in self.model.objects.filter(
-#            pk__in=pks) if item]
-        
+        if isinstance(index, slice):
+            return fetch_in_order(self.model, self._get_pks(index))
+        pks = self._get_pks(slice(index, index + 1))
+        if not pks:
+            raise IndexError('Search result index out of range.')
+        result = fetch_in_order(self.model, pks)
+        if not result:
+            raise IndexError('The indexed entity does not exist, anymore.')
+        return result[0]
+
+    def iterator(self, batch_size=ITERATOR_BATCH_SIZE):
+        # Page via cursors, so every batch costs the same
+        query = RelationIndexQuery(self.model, self.query, self.cursor,
+                                   self.search_manager, self.cache_key)
+        while True:
+            pks = query._get_pks(slice(0, batch_size))
+            for item in fetch_in_order(self.model, pks):
+                yield item
+            if len(pks) < batch_size:
+                return
+            query.cursor = query.next_cursor
+
+    def _get_pks(self, index):
+        if self.cache_key is None:
+            return self._fetch_pks(index)
+        key = 'search:%s' % md5(repr(self.cache_key + [
+            self.search_manager.get_cache_generation(), self.cursor,
+            (index.start, index.stop, index.step)])).hexdigest()
+        cached = cache.get(key)
+        if cached is not None:
+            pks, self.next_cursor = cached
+            return pks
+        pks = self._fetch_pks(index)
+        cache.set(key, (pks, self.next_cursor),
+                  self.search_manager.cache_timeout)
+        return pks
+
+    def _apply_cursor(self, query):
+        """Returns the query starting at the cursor and the offset to skip."""
+        if not self.cursor:
+            return query, 0
+        kind, value = decode_cursor(self.cursor)
+        if kind == 'c':
+            if set_cursor is None:
+                raise ValueError('The database backend does not support '
+                                 'datastore cursors.')
+            return set_cursor(query, start=value), 0
+        return query, value
+
+    def _fetch_pks(self, index):
+        query, offset = self._apply_cursor(self.query)
+        start = (index.start or 0) + offset
+        stop = index.stop
+        if stop is not None:
+            stop += offset
+        query = query[start:stop:index.step]
+        pks = [self._get_pk(item) for item in query]
+        if set_cursor is not None:
+            self.next_cursor = encode_cursor('c', get_cursor(query))
+        else:
+            self.next_cursor = encode_cursor('o', start + len(pks))
+        return pks
+
+    def _get_pk(self, item):
+        if isinstance(item, models.Model):
+            return item.pk
+        if isinstance(item, dict):
+            return item['pk']
+        return item
 
     def count(self):
         return self.query.count()
 
-    # TODO: add keys_only query
-#    def values(self, fields):
-#        pass
+    def keys(self, index=None):
+        """
+        Returns the pks of the results, starting at the cursor. The parent
+        entities don't get fetched. With a slice the (cached) pks of the slice
+        get returned, otherwise a query for all of them.
+        """
+        if index is not None:
+            return self._get_pks(index)
+        query, offset = self._apply_cursor(
+            self.query.values_list('pk', flat=True))
+        if offset:
+            query = query[offset:]
+        return query
+
+    def values_list(self, *field_names):
+        """
+        Returns a query for the given fields of the results. The values are
+        read from the relation index, so the fields have to be integrated.
+        """
+        return self.query.values_list(*field_names)
+
+def stream_rows(query, field_names=(), batch_size=ITERATOR_BATCH_SIZE):
+    """
+    Yields (pk, field values...) tuples of the given query in ascending pk
+    order.
+    """
+    query = query.order_by('pk').values_list('pk', *field_names)
+    last_pk = None
+    while True:
+        batch = query
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        rows = list(batch[:batch_size])
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        last_pk = rows[-1][0]
+
+def stream_keys(query, batch_size=ITERATOR_BATCH_SIZE):
+    """Yields the pks of the given query in ascending order."""
+    for row in stream_rows(query, batch_size=batch_size):
+        yield row[0]
+
+class KeyListQuery(QueryTraits):
+    """Base class for queries whose keys() method takes a slice."""
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return fetch_in_order(self.model, self.keys(index))
+        result = fetch_in_order(self.model, self.keys(slice(index, index + 1)))
+        if not result:
+            raise IndexError('Search result index out of range.')
+        return result[0]
+
+class TermMergeQuery(KeyListQuery):
+    """
+    Combines several relation index queries (e.g., one per term) in the
+    application by merging their keys-only results in pk order. Entities
+    returned by at least minimum_should_match queries (by default all of them)
+    match.
+
+    If all queries have to match, only the first query gets read completely,
+    so it should be the most selective one. Its keys are looked up in the
+    other queries chunk by chunk.
+
+    filter() gets applied to every query. order_by() sorts all matches in
+    memory using the values stored in the relation index. With
+    "rank_by_matches" entities returned by more queries come first and the
+    ordering only breaks ties.
+    """
+    def __init__(self, model, queries, minimum_should_match=None,
+            rank_by_matches=False):
+        self.model = model
+        self.queries = queries
+        if minimum_should_match is None:
+            minimum_should_match = len(queries)
+        self.minimum_should_match = max(minimum_should_match, 1)
+        self.rank_by_matches = rank_by_matches
+        self.ordering = ()
+        self._matches = None
+
+    def filter(self, *args, **kwargs):
+        self.queries = [query.filter(*args, **kwargs)
+                        for query in self.queries]
+        self._matches = None
+        return self
+
+    def order_by(self, *field_names):
+        self.ordering = field_names
+        self._matches = None
+        return self
+
+    def iter_matches(self):
+        """Yields (pk, number of matching queries) tuples in pk order."""
+        if self.minimum_should_match > len(self.queries):
+            return iter(())
+        if self.minimum_should_match == len(self.queries):
+            return self._iter_intersection()
+        return self._iter_union()
+
+    def _iter_intersection(self):
+        keys = stream_keys(self.queries[0], IN_QUERY_LIMIT)
+        while True:
+            chunk = list(itertools.islice(keys, IN_QUERY_LIMIT))
+            if not chunk:
+                return
+            matches = set(chunk)
+            for query in self.queries[1:]:
+                if not matches:
+                    break
+                matches = set(query.filter(pk__in=list(matches)).values_list(
+                    'pk', flat=True))
+            for pk in chunk:
+                if pk in matches:
+                    yield pk, len(self.queries)
+
+    def _iter_union(self):
+        current_pk, count = None, 0
+        for pk in heapq.merge(*[stream_keys(query)
+                                for query in self.queries]):
+            if count and pk == current_pk:
+                count += 1
+                continue
+            if count >= self.minimum_should_match:
+                yield current_pk, count
+            current_pk, count = pk, 1
+        if count and count >= self.minimum_should_match:
+            yield current_pk, count
+
+    def get_sorted_matches(self):
+        """
+        Returns all (pk, number of matching queries) tuples in result order.
+        They get computed once and reused for every slice and count(), so
+        after count() slices don't merge the queries again, either.
+        """
+        if self._matches is None:
+            matches = list(self.iter_matches())
+            if self.ordering and matches:
+                matches = self._sort_by_fields(matches)
+            if self.rank_by_matches:
+                matches.sort(key=lambda match: -match[1])
+            self._matches = matches
+        return self._matches
+
+    def _sort_by_fields(self, matches):
+        field_names = [field_name.lstrip('-') for field_name in self.ordering]
+        index_model = self.queries[0].model
+        pks = [pk for pk, count in matches]
+        values = {}
+        for start in range(0, len(pks), IN_QUERY_LIMIT):
+            for row in index_model.objects.filter(
+                    pk__in=pks[start:start + IN_QUERY_LIMIT]).values_list(
+                    'pk', *field_names):
+                values[row[0]] = row[1:]
+        matches = [match for match in matches if match[0] in values]
+        # Stable sorts from the last to the first ordering field
+        for position in reversed(range(len(field_names))):
+            matches.sort(key=lambda match: values[match[0]][position],
+                         reverse=self.ordering[position].startswith('-'))
+        return matches
+
+    def keys(self, index=slice(None)):
+        """Returns the pks of the (sliced) results."""
+        if self._matches is None and not self.ordering and \
+                not self.rank_by_matches and (index.start or 0) >= 0 and \
+                (index.stop is None or index.stop >= 0):
+            # Stop merging as soon as the slice is complete
+            matches = itertools.islice(self.iter_matches(), index.start,
+                                       index.stop, index.step)
+        else:
+            matches = self.get_sorted_matches()[index]
+        return [pk for pk, count in matches]
+
+    def iterator(self, batch_size=ITERATOR_BATCH_SIZE):
+        # Slicing would merge all earlier matches again for every batch, so
+        # all batches get taken from a single pass
+        if self._matches is None and not self.ordering and \
+                not self.rank_by_matches:
+            matches = self.iter_matches()
+        else:
+            matches = iter(self.get_sorted_matches())
+        while True:
+            pks = [pk for pk, count in itertools.islice(matches, batch_size)]
+            for item in fetch_in_order(self.model, pks):
+                yield item
+            if len(pks) < batch_size:
+                return
+
+    def count(self):
+        return len(self.get_sorted_matches())
+
+class ScoredQuery(KeyListQuery):
+    """
+    Orders the results of a RelationIndexQuery or TermMergeQuery by their
+    BM25 score (see SearchManager.score()). The scores get computed in memory,
+    so only the first SCORING_CANDIDATE_LIMIT matches get ranked.
+    """
+    def __init__(self, model, query, search_manager, words):
+        self.model = model
+        self.query = query
+        self.search_manager = search_manager
+        self.words = words
+        self._scores = None
+
+    def filter(self, *args, **kwargs):
+        self.query = self.query.filter(*args, **kwargs)
+        self._scores = None
+        return self
+
+    def get_scores(self):
+        """Returns (pk, score) tuples, best match first."""
+        if self._scores is None:
+            if isinstance(self.query, TermMergeQuery):
+                candidates = self.search_manager._get_term_frequencies(
+                    self.query.keys(slice(0, SCORING_CANDIDATE_LIMIT)))
+            else:
+                candidates = self.query.values_list('pk',
+                    self.search_manager.term_frequencies_field_name)[
+                    :SCORING_CANDIDATE_LIMIT]
+            self._scores = self.search_manager.score(candidates, self.words)
+        return self._scores
+
+    def keys(self, index=slice(None)):
+        """Returns the pks of the (sliced) results."""
+        return [pk for pk, score in self.get_scores()[index]]
+
+    def count(self):
+        return len(self.get_scores())
 
 def search(model, query, language=settings.LANGUAGE_CODE,
         search_index='search_index'):
@@ -0,0 +1,105 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_models, get_app, get_model
+from optparse import make_option
+from search.core import SearchManager, stream_keys, chunked
+import time
+
+def get_relation_index_managers(model):
+    return [manager for counter, manager_name, manager
+            in model._meta.concrete_managers
+            if isinstance(manager, SearchManager) and manager.relation_index]
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=100,
+            help='Number of entities to fetch and index at once.'),
+    )
+    help = ('Rebuilds the relation indexes of all models registered via '
+            'search.register(). Parents get read in batches. Index entities '
+            'get written in batches if the backend supports bulk_create(), '
+            'otherwise one by one.')
+    args = '[appname appname.ModelName ...]'
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive number.')
+
+        if args:
+            models = []
+            for label in args:
+                if '.' in label:
+                    model = get_model(*label.split('.', 1))
+                    if model is None:
+                        raise CommandError('Unknown model: %s' % label)
+                    models.append(model)
+                else:
+                    models.extend(get_models(get_app(label)))
+        else:
+            models = get_models()
+
+        for model in models:
+            managers = get_relation_index_managers(model)
+            if managers:
+                self.rebuild(model, managers, batch_size)
+
+    def rebuild(self, model, managers, batch_size):
+        name = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        queryset = model._default_manager.order_by('pk')
+        for manager in managers:
+            if manager.term_dictionary:
+                manager.reset_term_dictionary()
+        start = time.time()
+        count = 0
+        last_pk = None
+        while True:
+            batch = queryset
+            if last_pk is not None:
+                batch = batch.filter(pk__gt=last_pk)
+            parents = list(batch[:batch_size])
+            if not parents:
+                break
+            pks = [parent.pk for parent in parents]
+            for manager in managers:
+                manager.update_relation_indexes(pks, parents=parents,
+                                                rebuild=True)
+            count += len(parents)
+            last_pk = pks[-1]
+            self.stdout.write('%s: %d rows (%.1f rows/sec)\n' % (
+                name, count, count / max(time.time() - start, 0.001)))
+        for manager in managers:
+            removed = self.remove_orphans(model, manager, batch_size)
+            if removed:
+                self.stdout.write('%s.%s: removed %d orphaned index entities\n'
+                                  % (name, manager.name, removed))
+            if manager.term_filter:
+                manager.rebuild_term_filter(batch_size)
+        self.stdout.write('%s: rebuilt %d rows in %.1f seconds\n' % (
+            name, count, time.time() - start))
+
+    def remove_orphans(self, model, manager, batch_size):
+        """Deletes the index entities whose parent doesn't exist, anymore."""
+        index_query = manager._relation_index_model.objects.all()
+        removed = 0
+        pks = []
+        for pk in stream_keys(index_query, batch_size):
+            pks.append(pk)
+            if len(pks) >= batch_size:
+                removed += self.remove_orphaned_pks(model, manager, pks)
+                pks = []
+        if pks:
+            removed += self.remove_orphaned_pks(model, manager, pks)
+        return removed
+
+    def remove_orphaned_pks(self, model, manager, pks):
+        existing = set()
+        for chunk in chunked(pks):
+            existing.update(model._default_manager.filter(
+                pk__in=chunk).values_list('pk', flat=True))
+        orphans = [pk for pk in pks if pk not in existing]
+        if orphans:
+            # Without parents the index entities just get deleted. The term
+            # dictionary was reset by the rebuild, so it doesn't count them.
+            manager.update_relation_indexes(orphans, parents=[], rebuild=True)
+        return len(orphans)
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_models, get_app, get_model
+from optparse import make_option
+from search.management.commands.rebuild_search_index import \
+    get_relation_index_managers
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', dest='batch_size',
+            type='int', default=100,
+            help='Number of index entities to fetch at once.'),
+    )
+    help = ('Rebuilds the term filters of all search indexes registered with '
+            'term_filter=True. Run it periodically, since index updates '
+            'adding new terms make the filters stale.')
+    args = '[appname appname.ModelName ...]'
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be a positive number.')
+
+        if args:
+            models = []
+            for label in args:
+                if '.' in label:
+                    model = get_model(*label.split('.', 1))
+                    if model is None:
+                        raise CommandError('Unknown model: %s' % label)
+                    models.append(model)
+                else:
+                    models.extend(get_models(get_app(label)))
+        else:
+            models = get_models()
+
+        for model in models:
+            for manager in get_relation_index_managers(model):
+                if not manager.term_filter:
+                    continue
+                if manager.rebuild_term_filter(batch_size):
+                    status = 'rebuilt'
+                else:
+                    status = 'rebuilt, but already stale due to index updates'
+                self.stdout.write('%s.%s.%s: %s\n' % (
+                    model._meta.app_label, model._meta.object_name,
+                    manager.name, status))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from optparse import make_option
+from search.core import analyze, edge_ngrams
+
+def get_index_sizes(documents, splitter, indexer):
+    return [len(set(index)) for index in analyze(documents, splitter, indexer)]
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--index', action='store', dest='search_index',
+            default='search_index', help='Name of the search index.'),
+        make_option('--sample', action='store', dest='sample', type='int',
+            default=1000, help='Number of entities to analyze.'),
+        make_option('--min-length', action='store', dest='min_length',
+            type='int', default=1, help='Minimum prefix length.'),
+        make_option('--max-length', action='store', dest='max_length',
+            type='int', default=None, help='Maximum prefix length.'),
+        make_option('--fields', action='store', dest='fields', default=None,
+            help='Comma separated list of fields which get prefixes.'),
+    )
+    help = ("Compares the number of index values per entity of the search "
+            "index's current configuration with an edge_ngrams() indexer.")
+    args = 'appname.ModelName'
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('Please specify a model as appname.ModelName.')
+        model = get_model(*args[0].split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model: %s' % args[0])
+        manager = getattr(model, options['search_index'], None)
+        if manager is None:
+            raise CommandError('%s has no search index called %s.' % (
+                args[0], options['search_index']))
+
+        fields = options['fields']
+        if fields:
+            fields = fields.split(',')
+        indexer = edge_ngrams(options['min_length'], options['max_length'],
+                              fields)
+
+        index_field = manager.get_index_field()
+        documents = [index_field.get_document(instance) for instance
+                     in model._default_manager.all()[:options['sample']]]
+        if not documents:
+            raise CommandError('There are no entities to analyze.')
+        for name, sizes in (
+                ('current', get_index_sizes(documents, manager.splitter,
+                                            manager.indexer)),
+                ('edge_ngrams', get_index_sizes(documents, manager.splitter,
+                                                indexer))):
+            self.stdout.write('%s: %d values in total, %.1f per entity, '
+                              '%d max\n' % (name, sum(sizes),
+                              float(sum(sizes)) / len(sizes), max(sizes)))
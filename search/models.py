@@ -0,0 +1,188 @@
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+import random
+
+try:
+    from djangoappengine.db.utils import commit_locked
+except ImportError:
+    # Other backends update the counters via F() expressions
+    commit_locked = None
+
+IN_QUERY_LIMIT = getattr(settings, 'SEARCH_IN_QUERY_LIMIT', 100)
+# Number of entities the statistics of each index get spread over, so
+# concurrent updates don't all write the same entity. Only ever increase it,
+# shards beyond the limit get ignored.
+STATISTICS_SHARDS = getattr(settings, 'SEARCH_STATISTICS_SHARDS', 10)
+
+def _add_to_entity(manager, pk, deltas, defaults, delete_field):
+    try:
+        entity = manager.get(pk=pk)
+        exists = True
+    except manager.model.DoesNotExist:
+        entity = manager.model(pk=pk, **defaults)
+        exists = False
+    for name, delta in deltas.items():
+        setattr(entity, name, getattr(entity, name) + delta)
+    if delete_field is None or getattr(entity, delete_field) > 0:
+        entity.save()
+    elif exists:
+        entity.delete()
+
+def add_to_counters(manager, pk, deltas, defaults={}, delete_field=None):
+    """
+    Atomically adds the {field_name: delta} changes to the entity with the
+    given pk, which gets created from "defaults" if it doesn't exist. With
+    "delete_field" the entity gets deleted once that field drops to zero.
+
+    On App Engine the update runs in a (retried) transaction, other backends
+    use F() expressions.
+    """
+    if commit_locked is not None:
+        return commit_locked(_add_to_entity)(manager, pk, deltas, defaults,
+                                             delete_field)
+    if not manager.filter(pk=pk).update(**dict(
+            (name, F(name) + delta) for name, delta in deltas.items())):
+        entity = manager.model(pk=pk, **defaults)
+        for name, delta in deltas.items():
+            setattr(entity, name, getattr(entity, name) + delta)
+        if delete_field is not None and getattr(entity, delete_field) <= 0:
+            return
+        savepoint = transaction.savepoint(using=manager.db)
+        try:
+            entity.save(force_insert=True, using=manager.db)
+        except IntegrityError:
+            # Somebody else created the entity in the meantime
+            transaction.savepoint_rollback(savepoint, using=manager.db)
+            return add_to_counters(manager, pk, deltas, defaults,
+                                   delete_field)
+        transaction.savepoint_commit(savepoint, using=manager.db)
+    if delete_field is not None:
+        manager.filter(pk=pk, **{delete_field + '__lte': 0}).delete()
+
+class IndexTermManager(models.Manager):
+    def update_frequencies(self, index_name, deltas, document_delta=0,
+            length_delta=0):
+        """
+        Adds the given {term: delta} changes to the document frequencies of
+        the index's terms. Terms which don't occur anymore get removed.
+        document_delta and length_delta get added to the index's document
+        count and total document length (see IndexStatistics).
+
+        The frequencies get updated atomically. Terms never disappear
+        temporarily, so prefix searches keep working during updates.
+        """
+        if document_delta or length_delta:
+            IndexStatistics.objects.add(index_name, document_delta,
+                                        length_delta)
+        deltas = dict((term, delta) for term, delta in deltas.items() if delta)
+        if not deltas:
+            return
+        keys = dict((self.model.get_key(index_name, term), term)
+                    for term in deltas)
+        if commit_locked is not None:
+            # Every term is its own entity group
+            for key, term in keys.items():
+                add_to_counters(self, key,
+                    {'document_frequency': deltas[term]},
+                    {'index_name': index_name, 'term': term},
+                    delete_field='document_frequency')
+            return
+
+        # Most deltas are +1 or -1, so grouping the terms by their delta
+        # needs few queries
+        by_delta = {}
+        for key, term in keys.items():
+            by_delta.setdefault(deltas[term], []).append(key)
+        for delta, key_list in by_delta.items():
+            for start in range(0, len(key_list), IN_QUERY_LIMIT):
+                self.filter(pk__in=key_list[start:start + IN_QUERY_LIMIT]
+                    ).update(document_frequency=F('document_frequency') +
+                             delta)
+        key_list = keys.keys()
+        existing = set()
+        for start in range(0, len(key_list), IN_QUERY_LIMIT):
+            chunk = key_list[start:start + IN_QUERY_LIMIT]
+            existing.update(self.filter(pk__in=chunk).values_list('pk',
+                                                                   flat=True))
+            self.filter(pk__in=chunk, document_frequency__lte=0).delete()
+        missing = [self.model(pk=key, index_name=index_name, term=term,
+                              document_frequency=deltas[term])
+                   for key, term in keys.items()
+                   if key not in existing and deltas[term] > 0]
+        if not missing:
+            return
+        savepoint = transaction.savepoint(using=self.db)
+        try:
+            if hasattr(self, 'bulk_create'):
+                self.bulk_create(missing)
+            else:
+                for index_term in missing:
+                    index_term.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            # Concurrent updates created some of the terms
+            transaction.savepoint_rollback(savepoint, using=self.db)
+            for index_term in missing:
+                add_to_counters(self, index_term.pk,
+                    {'document_frequency': index_term.document_frequency},
+                    {'index_name': index_name, 'term': index_term.term},
+                    delete_field='document_frequency')
+        else:
+            transaction.savepoint_commit(savepoint, using=self.db)
+
+class IndexStatisticsManager(models.Manager):
+    def get_shard_keys(self, index_name):
+        # The first shard is keyed by the index name, so statistics stored
+        # before sharding still count
+        return [index_name] + [u'%s:%d' % (index_name, shard)
+                               for shard in range(1, STATISTICS_SHARDS)]
+
+    def get_for_index(self, index_name):
+        """Returns the (unsaved) sum of the index's statistics shards."""
+        statistics = self.model(pk=index_name)
+        for shard in self.filter(pk__in=self.get_shard_keys(index_name)):
+            statistics.document_count += shard.document_count
+            statistics.total_length += shard.total_length
+        return statistics
+
+    def add(self, index_name, document_delta=0, length_delta=0):
+        """Adds the deltas to a random shard of the index's statistics."""
+        add_to_counters(self, random.choice(self.get_shard_keys(index_name)),
+                        {'document_count': document_delta,
+                         'total_length': length_delta})
+
+    def delete_for_index(self, index_name):
+        self.filter(pk__in=self.get_shard_keys(index_name)).delete()
+
+class IndexStatistics(models.Model):
+    """
+    Corpus statistics of a search index, sharded over several entities (see
+    IndexStatisticsManager.get_for_index()).
+    """
+    # The index name, followed by the shard number for all but the first shard
+    id = models.CharField(max_length=200, primary_key=True)
+    document_count = models.IntegerField(default=0)
+    # Sum of all document lengths (only maintained with scoring)
+    total_length = models.IntegerField(default=0)
+
+    objects = IndexStatisticsManager()
+
+class IndexTerm(models.Model):
+    """
+    A distinct term of a search index together with the number of indexed
+    entities containing it. The terms are used for prefix search via range
+    queries.
+    """
+    id = models.CharField(max_length=500, primary_key=True)
+    index_name = models.CharField(max_length=200)
+    term = models.CharField(max_length=500)
+    document_frequency = models.IntegerField(default=0)
+
+    objects = IndexTermManager()
+
+    @classmethod
+    def get_key(cls, index_name, term):
+        return u'%s:%s' % (index_name, term)
+
+    def __unicode__(self):
+        return u'%s (%d)' % (self.term, self.document_frequency)
@@ -0,0 +1,106 @@
+# Registry of the available stemmers. Each stemmer is a function taking a word
+# and returning its stem.
+from django.conf import settings
+import threading
+
+_stemmers = {}
+# Maps requested language codes (e.g., 'de-at') to the resolved stemmer
+_resolved = {}
+
+def register_stemmer(language, stem):
+    """Registers a stem function for the given language code."""
+    _stemmers[language] = stem
+    _resolved.clear()
+
+def _load_stemmer(language):
+    if language not in _stemmers:
+        try:
+            stem = __import__('search.porter_stemmers.%s' % language,
+                              {}, {}, ['']).stem
+        except (ImportError, AttributeError, ValueError):
+            # Remember missing stemmers, so we don't retry the import
+            stem = None
+        _stemmers[language] = stem
+    return _stemmers[language]
+
+def get_stemmer(language):
+    """
+    Returns the stem function for the given language code. Codes like 'de-at'
+    fall back to 'de' and unknown languages fall back to English.
+    """
+    if language in _resolved:
+        return _resolved[language]
+    languages = [language]
+    if '-' in language:
+        languages.append(language.split('-')[0])
+    languages.append('en')
+    for candidate in languages:
+        stem = _load_stemmer(candidate)
+        if stem is not None:
+            break
+    _resolved[language] = stem
+    return stem
+
+class StemCache(object):
+    """
+    Bounded LRU cache of stems keyed on (language, word), shared by all
+    stemmers. Set max_size to 0 to disable caching.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self.hits = self.misses = 0
+            self._links = {}
+            # Circular doubly linked list of [previous, next, key, stem] links
+            # with the least recently used link right after the root
+            self._root = root = []
+            root[:] = [root, root, None, None]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._links)
+
+    def stem(self, language, word, stem):
+        """Returns the cached stem of word or caches the result of stem(word)."""
+        key = (language, word)
+        self._lock.acquire()
+        try:
+            link = self._links.get(key)
+            if link is not None:
+                self.hits += 1
+                # Move the link to the most recently used end
+                link[0][1], link[1][0] = link[1], link[0]
+                root = self._root
+                last = root[0]
+                last[1] = root[0] = link
+                link[0], link[1] = last, root
+                return link[3]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        result = stem(word)
+
+        self._lock.acquire()
+        try:
+            if key in self._links or self.max_size <= 0:
+                return result
+            root = self._root
+            last = root[0]
+            link = [last, root, key, result]
+            last[1] = root[0] = self._links[key] = link
+            while len(self._links) > self.max_size:
+                oldest = root[1]
+                root[1], oldest[1][0] = oldest[1], root
+                del self._links[oldest[2]]
+        finally:
+            self._lock.release()
+        return result
+
+stem_cache = StemCache(getattr(settings, 'SEARCH_STEM_CACHE_SIZE', 10000))
@@ -17,6 +17,7 @@
 
 #   Wer mit Strings arbeitet, sollte dieses Modul laden
 import string
+from search.porter_stemmers import stem_cache
 
 #   Die Stopliste; Wörter in dieser Liste werden nicht 'gestemmt', wenn stop  = 'True' an die Funktion übergeben wurde
 stopliste = (u'aber', u'alle', u'allem', u'allen', u'aller', u'alles', u'als', u'also', u'am', u'an', u'ander', u'andere', u'anderem',
@@ -40,6 +41,12 @@ stopliste = (u'aber', u'alle', u'allem', u'allen', u'aller', u'alles', u'als', u
 
 #   Die Funktion stem nimmt ein Wort und versucht dies durch Regelanwendung zu verkürzen. Wenn Stop auf 'True' gesetzt wird, werden Wörter in der Stopliste nicht 'gestemmt'.
 def stem(wort, stop=True):
+    #   Nur das Standardverhalten (stop=True) wird im gemeinsamen Cache abgelegt
+    if stop == True:
+        return stem_cache.stem('de', wort, _stem)
+    return _stem(wort, stop)
+
+def _stem(wort, stop=True):
     #   ACHTUNG: für den Stemmer gilt 'y' als Vokal.
     vokale = u'aeiouyäüö'
     #   ACHTUNG: 'U' und 'Y' gelten als Konsonaten.
@@ -25,6 +25,7 @@
 
 See http://snowball.tartarus.org/algorithms/english/stemmer.html"""
 import unittest, re
+from search.porter_stemmers import stem_cache
 
 regexp = re.compile(r"[^aeiouy]*[aeiouy]+[^aeiouy](\w*)")
 def get_r1(word):
@@ -267,7 +268,7 @@ exceptional_early_exit_post_1a = ['inning', 'outing', 'canning', 'herring', 'ear
 
 def stem(word):
     """The main entry point in the old version of the API."""
-    return Stemmer._stem(word)
+    return stem_cache.stem('en', word, Stemmer._stem)
 
 def algorithms():
     """Get a list of the names of the available stemming algorithms.
@@ -294,14 +295,13 @@ class Stemmer:
     function in this module. In addition, the appropriate stemming algorithm
     for a given language may be obtained by using the 2 or 3 letter ISO 639
     language codes.
-    """
-    max_cache_size = 10000
 
-    def __init__ (self, algorithm, cache_size=None):
+    Stems get cached in search.porter_stemmers.stem_cache, which is shared by
+    all stemmers (see the SEARCH_STEM_CACHE_SIZE setting).
+    """
+    def __init__ (self, algorithm):
         if algorithm not in ['english', 'eng', 'en']:
             raise KeyError("Stemming algorithm '%s' not found" % algorithm)
-        if cache_size:
-            self.max_cache_size = cache_size
 
     def stemWord(self, word):
         """Stem a word.
@@ -313,7 +313,7 @@ class Stemmer:
         was a unicode object, the result will be a unicode object: if the
         word supplied was a string, the result will be a UTF-8 encoded string.
         """
-        return Stemmer._stem(word)
+        return stem(word)
 
     def stemWords(self, words):
         """Stem a list of words.
@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
+from __future__ import with_statement
+from django.core.management import call_command
 from django.db import models
 from django.test import TestCase
+from StringIO import StringIO
 
 # use immediate_update on tests
 from django.conf import settings
 settings.SEARCH_BACKEND = 'search.backends.immediate_update'
 
 from search import register
-from search.core import SearchManager, startswith
-from search.utils import partial_match_search
+from search.models import IndexTerm, IndexStatistics
+from search.core import SearchManager, startswith, porter_stemmer, analyze, \
+    edge_ngrams, default_splitter, get_word_combinations, hyphenation_stats, \
+    TermMergeQuery, count_terms, non_stop
+from search.porter_stemmers import register_stemmer, stem_cache
+from search.utils import partial_match_search, run_concurrently, \
+    get_exact_match_terms_field, comma_splitter
+import time
 
 
 # ExtraData is used for ForeignKey tests
@@ -35,6 +44,8 @@ class Indexed(models.Model):
 register(Indexed, 'one', search_index='one_index', indexer=startswith)
 register(Indexed, ('one', 'two'), search_index='one_two_index')
 register(Indexed, 'value', integrate=('one', 'check'), search_index='value_index')
+register(Indexed, 'one', search_index='one_prefix_index',
+         indexer=edge_ngrams(2, 5), integrate=())
 
 # Test filters
 class FiltersIndexed(models.Model):
@@ -42,6 +53,24 @@ class FiltersIndexed(models.Model):
     check = models.BooleanField()
 
 register(FiltersIndexed, 'value', filters={'check':True, }, search_index='checked_index')
+register(FiltersIndexed, 'value',
+         filters={'value__call': lambda value: value.startswith('value')},
+         exclude={'check': True}, search_index='unchecked_index')
+register(FiltersIndexed, 'value', search_index='cached_index',
+         cache_timeout=60)
+register(FiltersIndexed, 'value', search_index='term_filter_index',
+         term_filter=True)
+
+# Test term dictionary
+class TermsIndexed(models.Model):
+    text = models.CharField(max_length=500)
+
+register(TermsIndexed, 'text', search_index='terms_index',
+         term_dictionary=True)
+register(TermsIndexed, 'text', search_index='scored_index',
+         term_dictionary=True, scoring=True)
+register(TermsIndexed, 'text', search_index='comma_scored_index',
+         splitter=comma_splitter, term_dictionary=True, scoring=True)
 
 class TestIndexed(TestCase):
     def setUp(self):
@@ -86,6 +115,7 @@ class TestIndexed(TestCase):
 
         # test filters
         self.assertEqual(len(FiltersIndexed.checked_index.search('test-word')), 1)
+        self.assertEqual(len(FiltersIndexed.unchecked_index.search('test-word')), 2)
         self.assertEqual(len(Indexed.value_index.search('foobar')), 0)
 
     def test_change(self):
@@ -106,6 +136,479 @@ class TestIndexed(TestCase):
         value.delete()
         self.assertEqual(len(Indexed.value_index.search('value3')), 0)
 
+    def test_skip_unchanged(self):
+        relation_index_model = Indexed.value_index._relation_index_model
+        indexed = Indexed.value_index.search('value0').get()
+        relation_index_model.objects.filter(pk=indexed.pk).delete()
+
+        # "two" is neither indexed nor integrated, so the index isn't touched
+        indexed = Indexed.objects.get(pk=indexed.pk)
+        indexed.two = 'changed'
+        indexed.save()
+        self.assertEqual(len(Indexed.value_index.search('value0')), 0)
+
+        indexed.check = True
+        indexed.save()
+        self.assertEqual(len(Indexed.value_index.search('value0').filter(
+            check=True)), 1)
+
+    def test_immediate_update(self):
+        # the saved instance gets indexed without re-reading it
+        indexed = Indexed.one_two_index.search('foo bar').get()
+        def get(*args, **kwargs):
+            raise AssertionError('The parent got re-read.')
+        Indexed.objects.get = get
+        try:
+            indexed.two = 'baz'
+            indexed.save()
+        finally:
+            del Indexed.objects.get
+        self.assertEqual(len(Indexed.one_two_index.search('foo baz')), 1)
+
+    def test_legacy_backend(self):
+        # backends with the old signature don't get the instance
+        import sys, types
+        from search.backends import immediate_update
+        calls = []
+        def update_relation_index(search_manager, parent_pk, delete):
+            calls.append(parent_pk)
+            immediate_update.update_relation_index(search_manager, parent_pk,
+                                                   delete)
+        backend = types.ModuleType('legacy_search_backend')
+        backend.update_relation_index = update_relation_index
+        sys.modules['legacy_search_backend'] = backend
+        settings.SEARCH_BACKEND = 'legacy_search_backend'
+        try:
+            indexed = Indexed.one_two_index.search('foo bar').get()
+            indexed.two = 'baz'
+            indexed.save()
+        finally:
+            settings.SEARCH_BACKEND = 'search.backends.immediate_update'
+            del sys.modules['legacy_search_backend']
+        self.assertTrue(calls)
+        self.assertEqual(len(Indexed.one_two_index.search('foo baz')), 1)
+
+    def test_coalesced_update(self):
+        from search.backends.coalesced_update import coalesced_updates
+        settings.SEARCH_BACKEND = 'search.backends.coalesced_update'
+        try:
+            with coalesced_updates():
+                indexed = Indexed.one_two_index.search('foo bar').get()
+                indexed.two = 'baz'
+                indexed.save()
+                indexed.two = 'qux'
+                indexed.save()
+                # unsaved changes don't get indexed
+                indexed.two = 'quux'
+                self.assertEqual(
+                    len(Indexed.one_two_index.search('foo bar')), 1)
+            self.assertEqual(len(Indexed.one_two_index.search('foo bar')), 0)
+            self.assertEqual(len(Indexed.one_two_index.search('foo baz')), 0)
+            self.assertEqual(len(Indexed.one_two_index.search('foo qux')), 1)
+            self.assertEqual(len(Indexed.one_two_index.search('foo quux')), 0)
+
+            # outside of requests and blocks updates get written immediately
+            indexed.save()
+            self.assertEqual(len(Indexed.one_two_index.search('foo quux')), 1)
+        finally:
+            settings.SEARCH_BACKEND = 'search.backends.immediate_update'
+
+    def test_batched_background_tasks(self):
+        from search.backends import gae_background_tasks, local_queue
+        settings.SEARCH_BACKEND = 'search.backends.gae_background_tasks'
+        settings.SEARCH_LOCAL_TASK_QUEUE = True
+        try:
+            for indexed in Indexed.one_two_index.search('bar'):
+                indexed.two = 'baz'
+                indexed.save()
+                indexed.two = 'qux'
+                indexed.save()
+            gae_background_tasks.flush()
+            # one task for each search manager integrating "two"
+            self.assertEqual(len(local_queue.tasks), 2)
+            self.assertEqual(len(Indexed.one_two_index.search('bar')), 2)
+
+            self.assertEqual(local_queue.run_tasks(), 2)
+            self.assertEqual(len(Indexed.one_two_index.search('bar')), 0)
+            self.assertEqual(len(Indexed.one_two_index.search('qux')), 2)
+
+            # outside of requests the window gets enforced by a timer
+            indexed = Indexed.one_two_index.search('qux')[0]
+            indexed.two = 'bar'
+            indexed.save()
+            gae_background_tasks._get_batch().timer.join(5)
+            self.assertEqual(local_queue.run_tasks(), 2)
+            self.assertEqual(len(Indexed.one_two_index.search('bar')), 1)
+        finally:
+            settings.SEARCH_BACKEND = 'search.backends.immediate_update'
+            del settings.SEARCH_LOCAL_TASK_QUEUE
+
+    def test_local_background_tasks(self):
+        from search.backends import local_background_tasks
+        settings.SEARCH_BACKEND = 'search.backends.local_background_tasks'
+        settings.SEARCH_SYNCHRONOUS_UPDATES = True
+        try:
+            indexed = Indexed.one_two_index.search('foo bar').get()
+            indexed.two = 'baz'
+            indexed.save()
+            self.assertEqual(len(Indexed.one_two_index.search('foo baz')), 1)
+        finally:
+            settings.SEARCH_BACKEND = 'search.backends.immediate_update'
+            del settings.SEARCH_SYNCHRONOUS_UPDATES
+
+    def test_local_background_tasks_queue(self):
+        from search.backends import local_background_tasks
+        import threading
+        # Workers use their own database connections, so record the updates
+        # instead of executing them
+        calls = []
+        started, release = threading.Event(), threading.Event()
+        main_thread = threading.currentThread()
+        def update(*args):
+            if threading.currentThread() is not main_thread:
+                started.set()
+                release.wait(5)
+            calls.append((args[3], threading.currentThread() is main_thread))
+        original_update = local_background_tasks.update
+        local_background_tasks.update = update
+        settings.SEARCH_WORKERS = 1
+        settings.SEARCH_QUEUE_SIZE = 1
+        settings.SEARCH_QUEUE_TIMEOUT = 0.01
+        try:
+            local_background_tasks.update_relation_index(
+                Indexed.one_two_index, 0, False)
+            started.wait(5)
+            for pk in (1, 2):
+                local_background_tasks.update_relation_index(
+                    Indexed.one_two_index, pk, False)
+            # the worker blocks the first update and the second one fills the
+            # queue, so the third one gets executed by the caller
+            self.assertEqual(calls, [(2, True)])
+            release.set()
+            local_background_tasks.drain()
+            self.assertEqual(sorted(calls),
+                             [(0, False), (1, False), (2, True)])
+
+            local_background_tasks.shutdown()
+            self.assertEqual(local_background_tasks._queue, None)
+            self.assertEqual(local_background_tasks._workers, [])
+        finally:
+            release.set()
+            local_background_tasks.shutdown()
+            local_background_tasks.update = original_update
+            del settings.SEARCH_WORKERS, settings.SEARCH_QUEUE_SIZE, \
+                settings.SEARCH_QUEUE_TIMEOUT
+
+    def test_stemmer_registry(self):
+        register_stemmer('xx', lambda word: word[:3])
+        self.assertEqual(porter_stemmer(['testing'], language='xx-yy'), ['tes'])
+        self.assertEqual(porter_stemmer(['testing'], language='zz'), ['test'])
+
+    def test_stem_cache(self):
+        stem_cache.clear()
+        self.assertEqual(porter_stemmer(['testing', 'testing'], language='en'),
+                         ['test', 'test'])
+        self.assertEqual((stem_cache.hits, stem_cache.misses), (1, 1))
+        stem_cache.clear()
+        self.assertEqual(len(stem_cache), 0)
+
+    def test_analyze(self):
+        words = []
+        def indexer(words_to_index, **kwargs):
+            words.extend(words_to_index)
+            return porter_stemmer(words_to_index, **kwargs)
+        indexer.tokenwise = True
+
+        result = analyze([([('one', [u'testing tests'])], 'en'),
+                          ([('one', [u'testing'])], 'en')], indexer=indexer)
+        self.assertEqual([sorted(index) for index in result],
+                         [['test', 'test'], ['test']])
+        self.assertEqual(sorted(words), ['testing', 'tests'])
+
+        # indexers without "per_field" get all words of a document at once
+        calls = []
+        def legacy_indexer(words, indexing, language):
+            calls.append(sorted(words))
+            return words
+        result = analyze([([('one', [u'a b']), ('two', [u'c'])], 'en')],
+                         indexer=legacy_indexer)
+        self.assertEqual(calls, [[u'a', u'b', u'c']])
+
+    def test_edge_ngrams(self):
+        self.assertEqual(len(Indexed.one_prefix_index.search('on')), 6)
+        self.assertEqual(len(Indexed.one_prefix_index.search('oneon')), 3)
+        # search terms get truncated to the maximum prefix length
+        self.assertEqual(len(Indexed.one_prefix_index.search('oneone1')), 3)
+        # there are no prefixes below the minimum length
+        self.assertEqual(len(Indexed.one_prefix_index.search('o')), 0)
+
+    def test_term_dictionary(self):
+        for text in ('hello world', 'help me', 'world peace'):
+            TermsIndexed(text=text).save()
+        index_name = TermsIndexed.terms_index.index_name
+        self.assertEqual(IndexTerm.objects.get(
+            pk=IndexTerm.get_key(index_name, 'world')).document_frequency, 2)
+
+        self.assertEqual(TermsIndexed.terms_index.expand_prefix('wo'),
+                         ['world'])
+        self.assertEqual(
+            len(TermsIndexed.terms_index.search('he', prefix=True)), 2)
+        self.assertEqual(
+            len(TermsIndexed.terms_index.search('world hel', prefix=True)), 1)
+        self.assertEqual(
+            len(TermsIndexed.terms_index.search('hex', prefix=True)), 0)
+
+        TermsIndexed.objects.get(text='help me').delete()
+        self.assertEqual(TermsIndexed.terms_index.expand_prefix('he'),
+                         ['hello'])
+
+    def test_query_planner(self):
+        for text in ('hello world', 'hello peace', 'world peace', 'hello'):
+            TermsIndexed(text=text).save()
+        manager = TermsIndexed.terms_index
+        self.assertEqual(IndexStatistics.objects.get_for_index(
+            manager.index_name).document_count, 4)
+        self.assertEqual(manager.plan_words(['hello', 'world']),
+                         ['world', 'hello'])
+        # document frequencies only order the words
+        self.assertEqual(manager.plan_words(['hello', 'unknown']),
+                         ['unknown', 'hello'])
+        self.assertEqual(len(manager.search('hello unknown')), 0)
+        self.assertEqual(len(manager.search('hello world')), 1)
+
+        index_manager = getattr(manager._relation_index_model, manager.name)
+        results = TermMergeQuery(TermsIndexed,
+            [index_manager.filter(['hello']), index_manager.filter(['peace'])])
+        self.assertEqual([item.text for item in results[:10]],
+                         [u'hello peace'])
+        results = TermMergeQuery(TermsIndexed,
+            [index_manager.filter(['hello']), index_manager.filter(['peace'])],
+            minimum_should_match=1).order_by('-text')
+        self.assertEqual(results.count(), 4)
+        self.assertEqual([item.text for item in results[1:3]],
+                         [u'hello world', u'hello peace'])
+
+        # iterating and counting merge the queries only once
+        results = TermMergeQuery(TermsIndexed,
+            [index_manager.filter(['hello']), index_manager.filter(['world'])])
+        calls = []
+        iter_matches = results.iter_matches
+        def counting_iter_matches():
+            calls.append(1)
+            return iter_matches()
+        results.iter_matches = counting_iter_matches
+        self.assertEqual([item.text for item in results.iterator(
+            batch_size=1)], [u'hello world'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results.count(), 1)
+        self.assertEqual(len(results[:10]), 1)
+        self.assertEqual(len(calls), 2)
+
+    def test_or_search(self):
+        results = Indexed.one_two_index.search('foo bar', operator='or')
+        self.assertEqual(len(results), 2)
+        # entities matching more words come first
+        self.assertEqual([item.one for item in results[:2]],
+                         [u'foo', u'foo_2'])
+        results = Indexed.one_two_index.search('foo bar unknown',
+            operator='or', minimum_should_match=2)
+        self.assertEqual([item.one for item in results[:10]], [u'foo'])
+        # entities can't match more words than the query has
+        results = Indexed.one_two_index.search('foo bar', operator='or',
+                                               minimum_should_match=3)
+        self.assertEqual(len(results), 0)
+        self.assertEqual(list(results[:10]), [])
+        # words ruled out by the term filter still count as non-matching
+        from django.core.cache import cache
+        manager = FiltersIndexed.term_filter_index
+        self.assertTrue(manager.rebuild_term_filter())
+        try:
+            self.assertEqual(len(manager.search('value0 zzz',
+                                                operator='or')), 1)
+            self.assertEqual(len(manager.search('value0 zzz', operator='or',
+                                                minimum_should_match=2)), 0)
+        finally:
+            # the filter would outlive this test
+            cache.delete_many(manager._get_term_filter_keys())
+        results = Indexed.one_index.search('one0 one1', operator='or')
+        self.assertEqual([item.one for item in results.order_by('-one')[:10]],
+                         [u'one1', u'one0'])
+        # sorted matches are computed once for all slices
+        results = Indexed.one_two_index.search('foo bar', operator='or')
+        calls = []
+        iter_matches = results.iter_matches
+        def counting_iter_matches():
+            calls.append(1)
+            return iter_matches()
+        results.iter_matches = counting_iter_matches
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results.keys(slice(0, 1)), results.keys()[:1])
+        self.assertEqual(len(calls), 1)
+        results.filter(one=u'foo_2')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(calls), 2)
+        self.assertRaises(ValueError, Indexed.one_index.search, 'one',
+                          minimum_should_match=1)
+
+    def test_ranked_search(self):
+        long_text = u'hello there, this is a much longer text about the world'
+        for text in (u'hello world', u'hello hello world', u'world peace',
+                     long_text):
+            TermsIndexed(text=text).save()
+        manager = TermsIndexed.scored_index
+        statistics = IndexStatistics.objects.get_for_index(manager.index_name)
+        self.assertEqual(statistics.document_count, 4)
+        self.assertEqual(statistics.total_length, 2 + 3 + 2 + 11)
+
+        results = manager.search('hello', ranked=True)
+        self.assertEqual([item.text for item in results[:3]],
+                         [u'hello hello world', u'hello world', long_text])
+        # rare words weigh more
+        results = manager.search('peace hello', operator='or', ranked=True)
+        self.assertEqual(results[0].text, u'world peace')
+        self.assertEqual(len(results), 4)
+        self.assertRaises(ValueError, TermsIndexed.terms_index.search, 'hello',
+                          ranked=True)
+
+        # rankings don't depend on the number of term filters
+        from search import core
+        core.MAX_TERM_FILTERS = 1
+        try:
+            results = manager.search('world hello', ranked=True)
+            self.assertEqual([item.text for item in results[:3]],
+                [u'hello hello world', u'hello world', long_text])
+        finally:
+            core.MAX_TERM_FILTERS = None
+
+        # query indexers dropping duplicates keep the term frequencies
+        self.assertEqual(count_terms(([('text', [u'hello hello world'])],
+                                      'en'), indexer=non_stop),
+                         ({u'hello': 2, u'world': 1}, 3))
+
+        TermsIndexed.objects.get(text=u'world peace').delete()
+        statistics = IndexStatistics.objects.get_for_index(manager.index_name)
+        self.assertEqual(statistics.document_count, 3)
+        self.assertEqual(statistics.total_length, 2 + 3 + 11)
+
+    def test_ranked_search_with_spaces(self):
+        # terms containing spaces survive the stored term frequencies
+        TermsIndexed(text=u'new york, berlin').save()
+        entity = TermsIndexed(text=u'new york')
+        entity.save()
+        manager = TermsIndexed.comma_scored_index
+        results = manager.search('new york', ranked=True)
+        self.assertEqual([item.text for item in results[:10]],
+                         [u'new york', u'new york, berlin'])
+        # updates read the stored lengths
+        entity.text = u'new york, paris'
+        entity.save()
+        self.assertEqual(len(manager.search('paris', ranked=True)), 1)
+        statistics = IndexStatistics.objects.get_for_index(manager.index_name)
+        self.assertEqual(statistics.total_length, 4)
+
+    def test_statistics_shards(self):
+        for i in range(20):
+            IndexStatistics.objects.add('sharded', 1, 2)
+        IndexStatistics.objects.add('sharded', -1, -2)
+        statistics = IndexStatistics.objects.get_for_index('sharded')
+        self.assertEqual(statistics.document_count, 19)
+        self.assertEqual(statistics.total_length, 38)
+        self.assertTrue(IndexStatistics.objects.filter(
+            pk__in=IndexStatistics.objects.get_shard_keys('sharded')).count()
+            > 1)
+        IndexStatistics.objects.delete_for_index('sharded')
+        self.assertEqual(IndexStatistics.objects.get_for_index(
+            'sharded').document_count, 0)
+
+    def test_word_combinations(self):
+        self.assertEqual(get_word_combinations(u'a-b-c-d', max_span=2),
+                         [u'a', u'b', u'c', u'd', u'ab', u'bc', u'cd'])
+        truncated = hyphenation_stats['truncated']
+        keywords = default_splitter(u'-'.join(u'abcdefghij'), indexing=True,
+                                    max_parts=3)
+        self.assertEqual(len(keywords), 10 + 3)
+        self.assertEqual(hyphenation_stats['truncated'], truncated + 1)
+
+    def test_result_order(self):
+        results = Indexed.one_two_index.search('bar').order_by('-one')
+        self.assertEqual([item.one for item in results[:2]],
+                         [u'foo_2', u'foo'])
+        results = Indexed.one_two_index.search('bar').order_by('one')
+        self.assertEqual([item.one for item in results[1:2]], [u'foo_2'])
+        self.assertEqual(results[1].one, u'foo_2')
+
+    def test_keys(self):
+        keys = Indexed.one_two_index.search('bar').order_by('one').keys()
+        self.assertEqual(list(keys),
+                         [Indexed.objects.get(one=u'foo').pk,
+                          Indexed.objects.get(one=u'foo_2').pk])
+
+    def test_cursor(self):
+        results = Indexed.one_two_index.search('bar').order_by('one')
+        self.assertEqual([item.one for item in results[:1]], [u'foo'])
+        cursor = results.next_cursor
+        results = Indexed.one_two_index.search('bar', cursor=cursor)
+        results = results.order_by('one')
+        self.assertEqual([item.one for item in results[:1]], [u'foo_2'])
+        self.assertEqual(list(results.with_cursor(results.next_cursor)[:1]),
+                         [])
+        # keys start at the cursor, too
+        results = Indexed.one_two_index.search('bar', cursor=cursor)
+        results = results.order_by('one')
+        foo_2 = Indexed.objects.get(one=u'foo_2').pk
+        self.assertEqual(list(results.keys()), [foo_2])
+        self.assertEqual(results.keys(slice(0, 1)), [foo_2])
+
+    def test_iterator(self):
+        results = Indexed.one_index.search('one').order_by('one')
+        self.assertEqual([item.one for item in results.iterator(batch_size=4)],
+                         [item.one for item in results[:10]])
+        self.assertEqual(len(list(results)), 6)
+
+        # index entities without parents don't end the iteration
+        index_model = Indexed.one_two_index._relation_index_model
+        orphan_pk = max(Indexed.objects.values_list('pk', flat=True)) + 1000
+        index_model(pk=orphan_pk, one=u'a', two=u'bar').save()
+        results = Indexed.one_two_index.search('bar', operator='or')
+        results = results.order_by('one')
+        self.assertEqual([item.one for item in results.iterator(batch_size=1)],
+                         [u'foo', u'foo_2'])
+
+    def test_search_cache(self):
+        self.assertEqual(
+            len(FiltersIndexed.cached_index.search('value0')[:10]), 1)
+        # empty queries match everything, queries without words nothing
+        manager = FiltersIndexed.cached_index
+        self.assertEqual(len(manager.search('')[:10]), 3)
+        self.assertEqual(len(manager.search('!!')[:10]), 0)
+        self.assertEqual(len(manager.search('a an the or')[:10]), 0)
+        self.assertEqual(len(manager.search('')[:10]), 3)
+        index_model = FiltersIndexed.cached_index._relation_index_model
+        index_model.objects.all().delete()
+        # The result is served from the cache
+        self.assertEqual(
+            len(FiltersIndexed.cached_index.search('value0')[:10]), 1)
+
+        # Index updates invalidate the cache
+        FiltersIndexed(value=u'value5').save()
+        self.assertEqual(
+            len(FiltersIndexed.cached_index.search('value0')[:10]), 0)
+
+    def test_term_filter(self):
+        manager = FiltersIndexed.term_filter_index
+        # without a filter nothing can be ruled out
+        self.assertFalse(manager.rules_out(['unknown']))
+        self.assertTrue(manager.rebuild_term_filter())
+        self.assertFalse(manager.rules_out(['value0', 'test']))
+        self.assertTrue(manager.rules_out(['value0', 'unknown']))
+        self.assertEqual(len(manager.search('value0 unknown')), 0)
+        self.assertEqual(len(manager.search('value0')), 1)
+
+        # new terms make the filter stale
+        FiltersIndexed(value=u'unknown').save()
+        self.assertEqual(manager.get_term_filter(), None)
+        self.assertEqual(len(manager.search('unknown')), 1)
+
     def test_partial_match_search(self):
         import logging
         results = partial_match_search(Indexed, 'bar',\
@@ -134,4 +637,45 @@ class TestIndexed(TestCase):
         self.assertEqual(repr(results[0]), "<Indexed: u'one0':u'two0':False:u''>")
         self.assertEqual(repr(results[5]), "<Indexed: u'OneOne2':u'':False:u''>")
 
+        results = partial_match_search(Indexed, 'one0 one1', search_index='one_two_index',
+                                       ranking_field='one', final_result_limit=1)
+        self.assertEqual([result.one for result in results], [u'one1'])
 
+        results = partial_match_search(Indexed, 'value0 test', search_index='value_index',
+                                       exact_match_field='value')
+        self.assertEqual([result.value for result in results], [u'value0 test-word'])
+
+        # value_index consists of "value", only, so its stored terms get used
+        self.assertEqual(get_exact_match_terms_field(Indexed, 'value_index', 'value'),
+                         'value_index_search_list_field')
+        self.assertEqual(get_exact_match_terms_field(Indexed, 'one_two_index', 'one'), None)
+
+    def test_run_concurrently(self):
+        # without max_workers the functions run in the calling thread
+        import threading
+        self.assertEqual(run_concurrently([threading.currentThread]),
+                         [threading.currentThread()])
+        self.assertEqual(run_concurrently([lambda: 1, lambda: 2, lambda: 3],
+                                          max_workers=2), [1, 2, 3])
+        # slow functions get dropped after the deadline
+        self.assertEqual(run_concurrently([lambda: 1,
+                                           lambda: time.sleep(1) or 2],
+                                          max_workers=2, timeout=0.2),
+                         [1, None])
+
+    def test_rebuild_search_index(self):
+        for manager in (Indexed.one_index, Indexed.one_two_index,
+                        Indexed.value_index):
+            manager._relation_index_model.objects.all().delete()
+        self.assertEqual(len(Indexed.one_two_index.search('foo bar')), 0)
+        index_model = Indexed.one_two_index._relation_index_model
+        orphan_pk = max(Indexed.objects.values_list('pk', flat=True)) + 1000
+        index_model(pk=orphan_pk, one=u'orphan', two=u'').save()
+
+        call_command('rebuild_search_index', 'search.Indexed', batch_size=4,
+                     stdout=StringIO())
+        self.assertFalse(index_model.objects.filter(pk=orphan_pk).exists())
+        self.assertEqual(len(Indexed.one_two_index.search('foo bar')), 1)
+        self.assertEqual(len(Indexed.one_index.search('oneo')), 3)
+        self.assertEqual(len(Indexed.value_index.search('value1').filter(
+            check=True)), 1)
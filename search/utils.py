@@ -1,13 +1,23 @@
 
+import heapq
 import logging
+import sys
+import threading
+import time
+from Queue import Queue, Empty
 from django.conf import settings
-from search.core import search, default_splitter, get_stop_words
+from search.core import search, default_splitter, get_stop_words, in_bulk, fetch_in_order
+
+# Maximum number of queries partial_match_search() runs at the same time. By
+# default they run one after another in the calling thread: other threads use
+# their own database connections, which don't see uncommitted data.
+QUERY_WORKERS = getattr(settings, 'SEARCH_QUERY_WORKERS', 1)
 
 
 def partial_match_search(model, query, query_filter_args=None, primary_rank_by_number_of_matches=True, ranking_field=None,
                          ranking_field_descending=True, exact_match_field=None, exact_match_min_keywords=2, blacklisted_keywords=[],
                          per_query_limit=40, debug=False, search_index='search_index', splitter=default_splitter,
-                         language=settings.LANGUAGE_CODE, final_result_limit=None):
+                         language=settings.LANGUAGE_CODE, final_result_limit=None, max_workers=None, deadline=None):
     """ 
     Args & Description:
     
@@ -20,7 +30,9 @@ def partial_match_search(model, query, query_filter_args=None, primary_rank_by_n
     sort is applied in descending order.
     
     If exact_match_field is set, any results matching all query keywords in the given field (in any order) will be 
-    returned as the only results. exact_match_min_keywords can be used to tune when this rule is applied.
+    returned as the only results. exact_match_min_keywords can be used to tune when this rule is applied. If the search
+    index consists of nothing but exact_match_field, the terms stored in the index are used, so hyphenated words also
+    match their combinations (see get_exact_match_terms_field()).
     
     blacklisted_keywords in the query are ignored.
     
@@ -28,12 +40,18 @@ def partial_match_search(model, query, query_filter_args=None, primary_rank_by_n
     entire query, and one for each keyword). The per_query_limit limits the number of results that are fetched for 
     each of these queries and therefore also effects the number of final (deduplicated) results that are returned. 
     query_filter_args can be set to filter each of these these queries and thereby restrict the final results.
+
+    The queries run concurrently on up to max_workers threads (default: settings.SEARCH_QUERY_WORKERS, which runs them
+    sequentially unless configured). Worker threads use their own database connections, so on SQL backends they don't
+    see uncommitted data. If deadline (in seconds) is set, the results of queries which didn't finish in time are
+    dropped.
     
     Setting debug=True will print some info logs as the search results are queried and sorted.
     
     Return:
     
-    Pre-sliced list of objects (not filterable).
+    Pre-sliced list of objects (not filterable). Only the final results get loaded, the candidates are ranked using
+    their pks and the ranking_field and exact_match_field values stored in the relation index.
     
     Simple example:
     results = partial_match_search(Indexed, 'foo bar', search_index='test_index')
@@ -52,93 +70,122 @@ def partial_match_search(model, query, query_filter_args=None, primary_rank_by_n
         if debug:
             logging.info("search keywords: " + (', ').join(keywords))
 
-        query_result_list = []
+        exact_match = exact_match_field and exact_match_min_keywords != None and \
+            len(keywords) >= exact_match_min_keywords
+        # If possible check exact matches using the terms stored in the search index instead of splitting the field
+        terms_field = None
+        if exact_match and not keywords & get_stop_words(language):
+            terms_field = get_exact_match_terms_field(model, search_index, exact_match_field, splitter)
+
+        # Only fetch pks and the fields needed for ranking, so candidates which
+        # don't make it into the final results never get loaded
+        fields = get_candidate_fields(model, search_index, ranking_field,
+                                      exact_match and (terms_field or exact_match_field) or None)
 
-        query_set = search(model, query, language, search_index)
-        if query_filter_args:
-            query_set = query_set.filter(**query_filter_args)
+        def get_query(query, order_by):
+            def run_query():
+                query_set = search(model, query, language, search_index)
+                if query_filter_args:
+                    query_set = query_set.filter(**query_filter_args)
+                if order_by:
+                    query_set = query_set.order_by(order_by)
+                return list(query_set.values_list('pk', *fields)[:per_query_limit])
+            return run_query
+
+        queries = []
         if ranking_field:
-            query_set = query_set.order_by('-' + ranking_field)
-            query_results = query_set[:per_query_limit]
-            query_result_list.extend(query_results)
+            queries.append((query, get_query(query, '-' + ranking_field)))
 
         for keyword in keywords:
-            query_set = search(model, keyword, language, search_index)
-            if query_filter_args:
-                query_set = query_set.filter(**query_filter_args)
+            order_by = None
             if ranking_field:
                 order_by = ranking_field
                 if ranking_field_descending:
                     order_by = '-' + ranking_field
-                query_set = query_set.order_by(order_by)
-            query_results = query_set[:per_query_limit]
-            if debug:
-                logging.info("Result for of query for '" + repr(keyword) + "': " + repr(query_results) )
-            query_result_list.extend(query_results)
+            queries.append((keyword, get_query(keyword, order_by)))
+
+        query_rows_list = run_concurrently([run_query for keyword, run_query in queries], max_workers, deadline)
 
         if debug:
             logging.info("Deduplicate and create primary search ranking based on how many keywords matched.")
-        query_result_set = {}
-        dedup_query_result_list = []
-        all_keyword_match_dedup_query_result_list = []
-        all_keyword_match = False
-        for result in query_result_list:
-            if exact_match_field and exact_match_min_keywords != None:
-
-                all_keyword_match = False
-                if len(keywords) >= exact_match_min_keywords:
-                    all_keyword_match = True
-                    exact_match_field_keywords = get_keyword_set(getattr(result, exact_match_field),
-                            blacklisted_keywords, splitter, language, debug)
-                    if len(keywords - exact_match_field_keywords) > 0:
-                        all_keyword_match = False
-            if result._get_pk_val() in query_result_set:
-                query_result_set[result._get_pk_val()].__partial_match_search__primary_rank += 1
-                if debug:
-                    logging.info("number " + repr(query_result_set[result._get_pk_val()].__partial_match_search__primary_rank) +
-                                 " instance of result: " + repr(result))
-            else:
-                if debug:
-                    logging.info("first instance of result: " + repr(result))
-                query_result_set[result._get_pk_val()] = result
-                setattr(query_result_set[result._get_pk_val()], '__partial_match_search__primary_rank', 1)
-                dedup_query_result_list.append(result)
-                if all_keyword_match:
-                    all_keyword_match_dedup_query_result_list.append(result)
-
-        if len(all_keyword_match_dedup_query_result_list) > 0:
+        # Candidates in the order they were first seen
+        candidates = []
+        primary_ranks = {}
+        candidate_values = {}
+        for (keyword, run_query), query_rows in zip(queries, query_rows_list):
+            if query_rows is None:
+                logging.warning("Query for '" + repr(keyword) + "' missed the deadline, dropping its results.")
+                continue
             if debug:
-                logging.info("All keywords matched at least one result exact_match_field.  Using only these matches: " +
-                             repr(len(all_keyword_match_dedup_query_result_list)))
-            dedup_query_result_list = all_keyword_match_dedup_query_result_list
-        else:
-            if debug:
-                logging.info("Found " + repr(len(dedup_query_result_list)) + " results.")
+                logging.info("Result for of query for '" + repr(keyword) + "': " + repr(query_rows))
+            for row in query_rows:
+                pk = row[0]
+                if pk in primary_ranks:
+                    primary_ranks[pk] += 1
+                else:
+                    primary_ranks[pk] = 1
+                    candidates.append(pk)
+                    candidate_values[pk] = dict(zip(fields, row[1:]))
+
+        # Entities which already got loaded
+        entities = None
+        if exact_match:
+            if not terms_field and exact_match_field not in fields:
+                # The field isn't stored in the relation index
+                entities = in_bulk(model, candidates)
+                for pk, entity in entities.items():
+                    candidate_values[pk][exact_match_field] = getattr(entity, exact_match_field)
+            # Many candidates share the same value, so split each value only once
+            field_keyword_sets = {}
 
+            def matches_all_keywords(pk):
+                values = candidate_values[pk]
+                if terms_field:
+                    return keywords.issubset(values[terms_field] or ())
+                if exact_match_field not in values:
+                    return False
+                value = values[exact_match_field]
+                if value not in field_keyword_sets:
+                    field_keyword_sets[value] = get_keyword_set(value, blacklisted_keywords, splitter, language, debug)
+                return not keywords - field_keyword_sets[value]
+
+            all_keyword_match_candidates = [pk for pk in candidates if matches_all_keywords(pk)]
+            if len(all_keyword_match_candidates) > 0:
+                if debug:
+                    logging.info("All keywords matched at least one result exact_match_field.  Using only these matches: " +
+                                 repr(len(all_keyword_match_candidates)))
+                candidates = all_keyword_match_candidates
+        if debug:
+            logging.info("Found " + repr(len(candidates)) + " results.")
+
+        # heapq's functions are equivalent to sorted(...)[:n], so ties keep their order
+        limit = final_result_limit or len(candidates)
         if ranking_field:
             if ranking_field_descending:
-                sorted_ranked_query_result_set = sorted(dedup_query_result_list, 
-                                                        key=lambda result: (result.__partial_match_search__primary_rank,
-                                                        getattr(result, ranking_field)), reverse=True)
+                ranked_pks = heapq.nlargest(limit, candidates,
+                    key=lambda pk: (primary_ranks[pk], candidate_values[pk][ranking_field]))
             else:
-                sorted_ranked_query_result_set = sorted(dedup_query_result_list, 
-                                                        key=lambda result: (-result.__partial_match_search__primary_rank,
-                                                        getattr(result, ranking_field)))
+                ranked_pks = heapq.nsmallest(limit, candidates,
+                    key=lambda pk: (-primary_ranks[pk], candidate_values[pk][ranking_field]))
         else:
-            sorted_ranked_query_result_set = sorted(dedup_query_result_list, 
-                                                        key=lambda result: -result.__partial_match_search__primary_rank)
+            ranked_pks = heapq.nsmallest(limit, candidates, key=lambda pk: -primary_ranks[pk])
 
-        if final_result_limit:
-            sorted_ranked_query_result_set = sorted_ranked_query_result_set[:final_result_limit]
+        # Hydrate the winners with a single batch get (unless they're loaded already)
+        if entities is not None:
+            sorted_ranked_query_result_set = [entities[pk] for pk in ranked_pks if pk in entities]
+        else:
+            sorted_ranked_query_result_set = fetch_in_order(model, ranked_pks)
+        for result in sorted_ranked_query_result_set:
+            setattr(result, '__partial_match_search__primary_rank', primary_ranks[result.pk])
 
         if debug:
             logging.info('final result ordering:')
             for result in sorted_ranked_query_result_set:
                 if ranking_field:
-                    logging.info("primary_rank: " + repr(result.__partial_match_search__primary_rank) + ", ranking_field: " +
+                    logging.info("primary_rank: " + repr(primary_ranks[result.pk]) + ", ranking_field: " +
                              repr(getattr(result, ranking_field)) + ", result: " + repr(result))
                 else:
-                    logging.info("primary_rank: " + repr(result.__partial_match_search__primary_rank) + ", result: " + repr(result))
+                    logging.info("primary_rank: " + repr(primary_ranks[result.pk]) + ", result: " + repr(result))
 
         return sorted_ranked_query_result_set
     except:
@@ -146,6 +193,101 @@ def partial_match_search(model, query, query_filter_args=None, primary_rank_by_n
         return None
 
 
+def get_candidate_fields(model, search_index, ranking_field=None, exact_match_field=None):
+    """
+    Returns the fields partial_match_search() reads from the search results
+    instead of loading the entities.
+    """
+    search_manager = getattr(model, search_index)
+    index_model = model
+    if search_manager.relation_index:
+        index_model = search_manager._relation_index_model
+    field_names = [field.name for field in index_model._meta.fields]
+    fields = []
+    for field_name in (ranking_field, exact_match_field):
+        if field_name and field_name in field_names and field_name not in fields:
+            fields.append(field_name)
+    return tuple(fields)
+
+
+def get_exact_match_terms_field(model, search_index, exact_match_field, splitter=default_splitter):
+    """
+    Returns the name of the index field whose stored terms contain the
+    keywords of exact_match_field or None if there's no such field. This is
+    the case if the search index consists of nothing but exact_match_field
+    split via default_splitter.
+
+    The stored terms are a superset of the keywords: indexing also stores the
+    combinations of hyphenated words (see get_word_combinations()), so e.g.
+    the query keyword "foobar" exactly matches a field containing "foo-bar".
+    This is the same way searches match these words.
+    """
+    search_manager = getattr(model, search_index)
+    if tuple(search_manager.fields_to_index) != (exact_match_field,) or search_manager.indexer is not None or \
+            search_manager.splitter is not default_splitter or splitter is not default_splitter:
+        return None
+    return search_manager.get_index_field().name
+
+
+def run_concurrently(functions, max_workers=None, timeout=None):
+    """
+    Calls the given functions on up to max_workers threads and returns their
+    results in the same order. With a timeout (in seconds) the results of
+    functions which didn't finish in time are None.
+    """
+    if max_workers is None:
+        max_workers = QUERY_WORKERS
+    if not functions or (max_workers <= 1 and timeout is None):
+        return [function() for function in functions]
+
+    pending = Queue()
+    for index, function in enumerate(functions):
+        pending.put((index, function))
+    finished = Queue()
+    cancelled = threading.Event()
+
+    def work():
+        try:
+            while not cancelled.isSet():
+                try:
+                    index, function = pending.get(False)
+                except Empty:
+                    return
+                try:
+                    finished.put((index, True, function()))
+                except:
+                    finished.put((index, False, sys.exc_info()))
+        finally:
+            # every thread has its own database connection
+            from django.db import connection
+            connection.close()
+
+    for i in range(min(max(max_workers, 1), len(functions))):
+        worker = threading.Thread(target=work)
+        worker.setDaemon(True)
+        worker.start()
+
+    results = [None] * len(functions)
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    try:
+        for i in range(len(functions)):
+            try:
+                if deadline is None:
+                    index, succeeded, result = finished.get()
+                else:
+                    index, succeeded, result = finished.get(True, max(deadline - time.time(), 0))
+            except Empty:
+                break
+            if not succeeded:
+                raise result[0], result[1], result[2]
+            results[index] = result
+    finally:
+        cancelled.set()
+    return results
+
+
 def get_keyword_set(query, blacklisted_keywords=[], splitter=default_splitter, language=settings.LANGUAGE_CODE,
                     debug=False):
     keywords = splitter(query, indexing=False, language=language)